@@ -6,14 +6,216 @@
 
 from __future__ import unicode_literals
 
-import math, abc, logging, time, imp, sys, os
+import math, abc, logging, time, imp, sys, os, re
+import collections, select, fcntl
 import moment
 from PIL import Image
 from PIL import ImageDraw
 from PIL import ImageFont
+from PIL import ImageChops
 
 import fonts
 
+class rendercache(object): # Bounded LRU cache of rendered images shared between widgets
+	def __init__(self, maxsize=256):
+		# Input
+		#	maxsize (integer) -- Maximum number of images to hold before the least recently used one is discarded
+
+		self.maxsize = maxsize
+		self.entries = collections.OrderedDict()	# key -> (fontpkg, image) in least to most recently used order
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+
+	def __len__(self):
+		return len(self.entries)
+
+	def get(self, key, fontpkg):
+		# Return the cached image for key or None if it has not been rendered (or was rendered with a different font)
+
+		try:
+			font, image = self.entries.pop(key)
+		except KeyError:
+			self.misses += 1
+			return None
+
+		# Keys use the id of the font so make sure the font has not been replaced (e.g. by a page reload)
+		if font is not fontpkg:
+			self.misses += 1
+			return None
+
+		# Move to the most recently used end
+		self.entries[key] = (font, image)
+		self.hits += 1
+		return image
+
+	def put(self, key, fontpkg, image):
+		# Images placed in the cache are shared so must not be modified after they are added
+
+		if self.maxsize <= 0:
+			return
+
+		self.entries.pop(key, None)
+		self.entries[key] = (fontpkg, image)
+		while len(self.entries) > self.maxsize:
+			self.entries.popitem(last=False)
+			self.evictions += 1
+
+	def clear(self):
+		self.entries.clear()
+
+	def stats(self):
+		return { 'size': len(self.entries), 'maxsize': self.maxsize, 'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions }
+
+# Variable transforms
+# --------------------------
+# Variables used by widgets can be transformed before being displayed by adding one or more transforms to the variable name
+# Format is the name of the transform preceded by a '|' and then if parameters are required a series of values seperated by '+' symbols
+# e.g. localtime|strftime+%-I:%M or random|onoff|Capitalize
+#
+# Each variable spec is parsed once into a pipeline of transform functions which is then reused every time the variable is evaluated.
+# New transforms can be added with registertransform without changing the widgets that use them.
+
+class transformabort(Exception): # Raised by a transform to end the pipeline and return the untransformed value
+	pass
+
+transformregistry = { }		# Transform name -> factory that builds the transform function
+compiledtransforms = { }	# Variable spec -> tuple of transform functions
+
+def registertransform(names, factory):
+	# Input
+	#	names (unicode or list) -- Name(s) used to request the transform.  Matched case insensitively
+	#	factory (function) -- Called with the transform name and a list of its parameters each time the transform appears in a spec.
+	#		Returns a function that receives the current value and the original value of the variable and returns the transformed value
+
+	if isinstance(names, basestring):
+		names = [ names ]
+	for name in names:
+		transformregistry[name.lower()] = factory
+
+def compiletransform(spec):
+	# Returns the pipeline of transform functions requested by a variable spec (e.g. localtime|strftime+%-I:%M)
+
+	try:
+		return compiledtransforms[spec]
+	except KeyError:
+		pass
+
+	pipeline = []
+	for request in spec.split(u'|')[1:]:
+		params = request.split(u'+')
+		name = params[0].lower() # Pull request type away from variables
+		factory = transformregistry.get(name)
+		if factory is None:
+			logging.debug(u"Unknown transform {0} requested in {1}.  Ignoring...".format(name, spec))
+			continue
+		pipeline.append(factory(name, params[1:]))
+
+	pipeline = tuple(pipeline)
+	compiledtransforms[spec] = pipeline
+	return pipeline
+
+# Boolean transforms
+# --------------------------
+# Input must be a boolean.  If not the untransformed value is returned
+# |onoff, |truefalse, |yesno
+def booltransform(name, params):
+	t, f = { u'onoff': (u'on', u'off'), u'truefalse': (u'true', u'false'), u'yesno': (u'yes', u'no') }[name]
+
+	def transform(retval, val):
+		if type(retval) is not bool:
+			raise transformabort
+		return t if val else f
+	return transform
+
+# |int - converts the variable into an integer (0 if it cannot be converted)
+def inttransform(name, params):
+	def transform(retval, val):
+		try:
+			return int(val)
+		except:
+			# Value not convertible to int
+			return 0
+	return transform
+
+# String transforms
+# --------------------------
+# Input must be a string.  If not the untransformed value is returned
+# |upper, |capitalize, |title, |lower
+def stringtransform(name, params):
+	method = { u'upper': unicode.upper, u'capitalize': unicode.capitalize, u'title': unicode.title, u'lower': unicode.lower }[name]
+
+	def transform(retval, val):
+		if type(retval) is str:
+			retval = retval.decode()
+		elif type(retval) is not unicode:
+			logging.debug(u"Request to perform {0} transform requires string input".format(name))
+			raise transformabort
+		return method(retval)
+	return transform
+
+# Time transforms
+# --------------------------
+# Input must be a moment object
+# |timezone+tz - converts utc referenced moment object into an equivalant moment object in the timezone requested by the tz parameter
+# |strftime+s - converts moment object into string formated using the strftime format string provided in the s parameter
+#               Also accepts an integer number of seconds
+def timetransform(name, params):
+	def transform(retval, val):
+		if type(retval) is moment.core.Moment:
+
+			if len(params) > 1:
+				# Safe to ignore but logging
+				logging.debug(u"Expected one parameter but received {0}".format(len(params)))
+
+			if len(params) == 0:
+				# Requires at least one variable to specify line so will return error in retval
+				logging.debug(u"Expected one parameter but received none")
+				return u"Err"
+
+			if name == u'timezone':
+				try:
+					return retval.timezone(params[0])
+				except ValueError:
+					# Received bad timezone value
+					logging.debug("Cannot convert timezone.  Requested timezone ({0}) is not valid".format(params[0]))
+					return retval
+
+			try:
+				return retval.strftime(params[0])
+			except:
+				logging.debug(u"Cannot format moment.  Bad strftime value provided ({0})".format(params[0]))
+				return u'Err'
+		elif name == u'strftime' and type(retval) is int:
+			return time.strftime(params[0], time.gmtime(int(retval)))
+
+		# Bad input provided
+		logging.debug(u'Expected a moment variable but received a {0}'.format(type(retval)))
+		return retval
+	return transform
+
+# |select+matchstring+replacestring+matchstring+replacestring+...
+# Replaces the variable with the replacestring of the first matchstring it equals (or a space if none match)
+def selecttransform(name, params):
+	if len(params)%2 != 0 or len(params)==0:
+		# Must have pairs of input (match+replace)
+		return lambda retval, val: u'Err'
+
+	pairs = [ (params[i], params[i+1]) for i in range(0,len(params),2) ]
+
+	def transform(retval, val):
+		for match, replace in pairs:
+			if retval == match:
+				return replace
+		return u' '
+	return transform
+
+registertransform([u'onoff', u'truefalse', u'yesno'], booltransform)
+registertransform(u'int', inttransform)
+registertransform([u'upper', u'capitalize', u'title', u'lower'], stringtransform)
+registertransform([u'timezone', u'strftime'], timetransform)
+registertransform(u'select', selecttransform)
+
 class widget:
 	__metaclass__ = abc.ABCMeta
 
@@ -28,6 +230,9 @@ class widget:
 		self.currentvardict = { }			# A record of any variables that have been used and their last value
 		self.variabledict = variabledict	# variabledict.  A pointer to the current active system variable db
 		self.curMsg = None					# If widget is derived from text, record the current message this widget was derived from
+		self.watched = False				# True if the display controller tells this widget when the variables it depends upon change
+		self.stale = True					# If watched, whether a variable this widget depends upon has changed since its last update
+		self.version = 0					# Incremented each time an update changes the image.  Lets every container of a shared widget see the change
 
 	@abc.abstractmethod
 	def update(self):
@@ -109,130 +314,15 @@ class widget:
 
 
 	def transformvariable(self, val, name):
-		# Implement transformation logic (e.g. |yesno, |onoff |upper |bigchars+0)
-		# Format of 'name' is the name of the transform preceded by a '|' and
-		# then if variables are required a series of values seperated by '+' symbols
-
-
-		transforms = name.split(u'|')
-		if len(transforms) == 0:
-			return ''
-		elif len(transforms) == 1:
-			return val
+		# Implement transformation logic (e.g. |yesno, |onoff |upper |strftime+%H:%M)
+		# Format of 'name' is the variable name followed by its transforms.  See compiletransform
 
 		retval = val
-		# Compute transforms
-		for i in range(1,len(transforms)):
-			transform_request = transforms[i].split(u'+')[0].lower() # Pull request type away from variables
-			if transform_request in [u'onoff',u'truefalse',u'yesno']:
-				# Make sure input is a Boolean
-				if type(retval) is bool:
-
-					if transform_request == u'onoff':
-						retval = u'on' if val else u'off'
-					elif transform_request == u'truefalse':
-						retval = u'true' if val else u'false'
-					elif transform_request == u'yesno':
-						retval = u'yes' if val else u'no'
-				else:
-#					logging.debug(u"Request to perform boolean transform on {0} requires boolean input".format(name))
-					return val
-			elif transform_request in [u'int']:
-				try:
-					retval = int(val)
-				except:
-					# Value not convertible to int
-					retval = 0
-			elif transform_request in [u'upper',u'capitalize',u'title',u'lower']:
-				# These all require string input
-
-				if type(retval) is str or type(retval) is unicode:
-					if type(retval) is str:
-						retval = retval.decode()
-					if transform_request == u'upper':
-						retval = retval.upper()
-					elif transform_request == u'capitalize':
-						retval = retval.capitalize()
-					elif transform_request == u'title':
-						retval = retval.title()
-					elif transform_request == u'lower':
-						retval = retval.lower()
-				else:
-					logging.debug(u"Request to perform transform on {0} requires string input".format(name))
-					return val
-
-# Time transforms
-# --------------------------
-# Input must be a moment object
-# |timezone+tz - converts utc referenced moment object into an equivalant moment object in the timezone requested by the tz parameter
-# |local - converts utc referenced moment object into an equivalant moment object in the local timezone (as specified in pydPiper_config.TIMEZONE variable)
-# |strftime+s - converts moment object into string formated using the strftime format string provided in the s parameter
-
-			elif transform_request in [ u'timezone', u'strftime' ]:
-				# requires a moment object as input
-
-				tvalues = transforms[i].split('+')[1:]
-
-				if type(retval) is moment.core.Moment:
-
-					if len(tvalues) > 1:
-						# Safe to ignore but logging
-						logging.debug(u"Expected one parameter but received {0}".format(len(values)))
-
-					if len(tvalues) == 0:
-						# Requires at least one variable to specify line so will return error in retval
-						logging.debug(u"Expected one parameter but received none")
-						retval = u"Err"
-					else:
-
-						if transform_request == u'timezone':
-							try:
-								retval = retval.timezone(tvalues[0])
-							except ValueError:
-								# Received bad timezone value
-								logging.debug("Cannot convert timezone.  Requested timezone ({0}) is not valid".format(tvalues[0]))
-
-						elif transform_request == u'strftime':
-							try:
-								retval = retval.strftime(tvalues[0])
-							except:
-								logging.debug(u"Cannot format moment.  Bad strftime value provided ({0})".format(tvalues[0]))
-								retval = u'Err'
-				elif transform_request in [u'strftime'] and type(retval) is int:
-					retval = time.strftime(tvalues[0], time.gmtime(int(retval)))
-				else:
-					# Bad input provided
-					logging.debug(u'Expected a moment variable but received a {0}'.format(type(retval)))
-
-			elif transform_request in [ u'select' ]:
-				# select replaces the variable with string based upon a matching pattern.
-				# <variable>|select+matchstring+replacestring+matchstring+replacestring+...
-
-				tvalues = transforms[i].split('+')[1:]
-				if len(tvalues)%2 != 0 or len(tvalues)==0:
-					# Must have pairs of input (match+replace)
-					retval = u'Err'
-				else:
-					for i in range(0,len(tvalues),2):
-						if retval == tvalues[i]:
-							retval = tvalues[i+1]
-							break
-					else:
-						retval = u' '
-
-#			elif transform_request in [ u'local' ]:
-#				# requires a moment object as input
-#
-#				if type(retval) is moment.core.Moment:
-#					try:
-#						retval = retval.timezone(pydPiper_config.TIMEZONE)
-#					except ValueError:
-#						# Received bad timezone value
-#						logging.debug("Cannot convert timezone.  Requested timezone ({0}) is not valid".format(pydPiper_config.TIMEZONE))
-#				else:
-#					# Bad input provided
-#					logging.debug(u'Expected a moment variable but received a {0}'.format(type(retval)))
-
+		try:
+			for transform in compiletransform(name):
+				retval = transform(retval, val)
+		except transformabort:
+			return val
 		return retval
 
 	def clear(self,image,x,y,width,height):
@@ -282,8 +372,24 @@ class widget:
 
 class gwidget(widget):
 
+	# Rendered text images shared by all text widgets.  Pages tend to show the same messages over and over (e.g. artist, title, time)
+	textcache = rendercache(256)
+
 	def update(self, reset=False):
 
+		# Widgets watched by the display controller only need to be re-evaluated when a variable they depend upon has changed
+		if self.watched:
+			if not self.stale and not reset:
+				return False
+			self.stale = False
+
+		if self.refresh(reset):
+			self.version += 1
+			return True
+		return False
+
+	def refresh(self, reset=False): # Re-render the widget.  Returns True if its image changed
+
 		# Moved change detection into widget
 #		if self.type in ['text', 'ttext']:
 #			if not self.changed(self.variables):
@@ -298,19 +404,32 @@ class gwidget(widget):
 		elif self.type == 'progressimagebar':
 			return self.progressimagebar(self.maskimage, self.value, self.rangeval, self.direction)
 		elif self.type == 'canvas':
-			retval = True if reset else False
-			for e in self.widgets:
-				widget,x,y,w,h = e
-				if widget.update(reset):
-					retval = True
-			# If a widget has changed
-			if retval:
-				# Replace all of the widgets
+			# A widget can be shared with other canvases so one that was updated through another
+			# canvas reports no change here.  Compare versions instead
+			changed = []
+			for i in range(len(self.widgets)):
+				widget,x,y,w,h = self.widgets[i]
+				widget.update(reset)
+				if widget.version != self.placedversion[i]:
+					changed.append(i)
+
+			# On reset replace all of the widgets
+			if reset:
 				self.clear()
-				for e in self.widgets:
-					widget,x,y,w,h = e
-					self.place(widget, (x,y), (w,h))
-			return retval
+				for i in range(len(self.widgets)):
+					widget,x,y,w,h = self.widgets[i]
+					self.placed[i] = self.place(widget, (x,y), (w,h))
+					self.placedversion[i] = widget.version
+				self.dirty = [ (0,0,self.image.size[0],self.image.size[1]) ]
+				return True
+
+			# If a widget has changed, repaint only the regions it used to and now occupies
+			if changed:
+				self.repaint(changed)
+				return True
+
+			self.dirty = []
+			return False
 		elif self.type == u'scroll':
 			return self.scroll(self.widget, self.direction, self.distance, self.speed, self.gap, self.hesitatetype, self.hesitatetime,self.threshold, reset)
 		elif self.type == u'popup':
@@ -319,6 +438,33 @@ class gwidget(widget):
 			# Static content like images, lines, rectangles do not need to be refreshed
 			return False
 
+	def dependencies(self):
+		# Returns the names of the system variables that the content of this widget is derived from
+		# or None if the widget needs to be updated every time (e.g. effects and canvases)
+
+		if self.type in [u'text', u'ttext']:
+			return set([ v.split(u'|')[0] for v in self.variables ])
+		elif self.type in [u'progressbar', u'progressimagebar']:
+			l,h = self.rangeval
+			return set([ v for v in (self.value, l, h) if type(v) is unicode ])
+		return None
+
+	def nextchange(self, now):
+		# Returns the earliest time that the image of this widget could change on its own (e.g. the next step of a scroll)
+		# or None if it only changes when the variables it depends upon change
+
+		if self.type == u'canvas':
+			return earliest([ widget.nextchange(now) for widget,x,y,w,h in self.widgets ])
+		elif self.type == u'scroll':
+			if not self.shouldscroll:
+				return self.widget.nextchange(now)
+			# Scrolls move every frame unless they are hesitating
+			return earliest([ max(self.end, now), self.widget.nextchange(now) ])
+		elif self.type == u'popup':
+			# Popups move every frame unless they are waiting to transition
+			return earliest([ max(self.end, now), self.widget.nextchange(now) ])
+		return None
+
 	# WIDGETS
 
 	# CANVAS widget functions
@@ -327,6 +473,9 @@ class gwidget(widget):
 		self.image = Image.new("1", (w,h) )
 		self.updatesize()
 		self.widgets = []
+		self.placed = []	# The region of the canvas each widget occupied when it was last placed
+		self.placedversion = []	# The version of each widget when it was last placed
+		self.dirty = []		# The regions of the canvas that changed during the last update
 
 	def add(self, widget, (x,y), (w,h)=(0,0)): # Add a widget to the canvas
 
@@ -335,20 +484,23 @@ class gwidget(widget):
 			return
 
 		self.widgets.append( (widget,x,y,w,h) )
-		self.place(widget, (x,y), (w,h) )
+		self.placed.append( self.place(widget, (x,y), (w,h) ) )
+		self.placedversion.append( widget.version )
 		return self
 
 	def clear(self): # Erase canvas
 		if self.type != u'canvas':
 			logging.warning('Trying to clear a widget that is not a canvas')
 			return
-		self.image = Image.new("1", (self.image.size[0], self.size[1]))
+		self.image.paste(0, (0,0,self.image.size[0],self.image.size[1]))
+		self.placed = [ None ] * len(self.widgets)
 
 	def place(self, widget, (x,y), size=(0,0)): # Place a widget's image on the canvas
 		# Input
 		#	widget (widget): widget to place
 		#	(x,y) (integer tuple): where to place it
 		#	size (integer tuple): how big should it be
+		# Returns the region of the canvas that the widget was placed into
 		if self.type != u'canvas':
 			logging.warning(u"Trying to place a widget on something that is not a canvas")
 			return
@@ -361,43 +513,84 @@ class gwidget(widget):
 
 		self.image.paste(img, (x,y))
 
-	# TEXT widget functions
-	def textsize(self, msg, fontpkg, varwidth): # returns the size needed to contain provided message
-		# Input
-		#	msg (unicode): string that contains the message for the calculation
-		#	fontpkg (fontpkg): the font to use for the calculation
-		#	varwidth (bool): Should the font be fixed or variable width
+		return (x, y, x+img.size[0], y+img.size[1])
 
-		maxw = 0
-		maxh = 0
-		cx = 0
-		(fx,fy) = fontpkg['size']
+	def region(self, e): # Return the region of the canvas covered by a widget entry (widget,x,y,w,h)
+		widget,x,y,w,h = e
+		if w > 0 or h > 0:
+			return (x, y, x+w, y+h)
+		return (x, y, x+widget.image.size[0], y+widget.image.size[1])
 
-		for c in msg:
+	def repaint(self, changed): # Repaint the regions of the canvas affected by the widgets that changed
+		# Input
+		#	changed (integer array): index of each widget (within self.widgets) that has changed
+
+		cw, ch = self.image.size
+
+		# Each changed widget dirties the region it used to occupy and the one it occupies now
+		rects = []
+		for i in changed:
+			widget,x,y,w,h = self.widgets[i]
+			box = self.region(self.widgets[i])
+
+			# A canvas that has not moved reports exactly which parts of it changed
+			# (but only for its last update so not if it was also updated elsewhere since it was placed here)
+			lastversion = self.placedversion[i]
+			self.placedversion[i] = widget.version
+			if widget.type == u'canvas' and box == self.placed[i] and (w,h) == (0,0) and widget.version == lastversion+1:
+				for dx0, dy0, dx1, dy1 in widget.dirty:
+					rects.append( (x+dx0, y+dy0, x+dx1, y+dy1) )
+				continue
 
-			if c == u'\n':
-				maxh = maxh + fy
-				if cx > maxw:
-					maxw = cx
-				cx = 0
+			if self.placed[i] is not None:
+				px0, py0, px1, py1 = self.placed[i]
+				box = (min(box[0],px0), min(box[1],py0), max(box[2],px1), max(box[3],py1))
+			rects.append(box)
+
+		# Merge overlapping regions so that no area is painted more than once
+		merged = []
+		while rects:
+			box = rects.pop()
+			box = (max(box[0],0), max(box[1],0), min(box[2],cw), min(box[3],ch))
+			if box[0] >= box[2] or box[1] >= box[3]:
 				continue
+			i = 0
+			while i < len(merged):
+				m = merged[i]
+				if box[0] < m[2] and m[0] < box[2] and box[1] < m[3] and m[1] < box[3]:
+					box = (min(box[0],m[0]), min(box[1],m[1]), max(box[2],m[2]), max(box[3],m[3]))
+					del merged[i]
+					i = 0
+				else:
+					i += 1
+			merged.append(box)
 
-			try:
-				charimg = fontpkg[ord(c)]
-			except KeyError:
-				# Requested character does not exist in font.  Replace with '?'
-				charimg = fontpkg[ord('?')]
+		# Erase each region and then paste back (in order) the part of every widget that overlaps it
+		for box in merged:
+			self.image.paste(0, box)
+			for e in self.widgets:
+				wx0, wy0, wx1, wy1 = self.region(e)
+				x0, y0 = max(box[0],wx0), max(box[1],wy0)
+				x1, y1 = min(box[2],wx1), min(box[3],wy1)
+				if x0 < x1 and y0 < y1:
+					img = e[0].image
+					if img.mode != self.image.mode:
+						img = img.convert(self.image.mode)
+					self.image.paste(img.crop( (x0-wx0, y0-wy0, x1-wx0, y1-wy0) ), (x0,y0))
 
-			if varwidth:
-				cx += charimg.size[0]
-			else:
-				cx += fx
+		for i in changed:
+			self.placed[i] = self.region(self.widgets[i])
+
+		self.dirty = merged
 
-		if cx > maxw:
-			maxw = cx
-		maxh = maxh + fy
+	# TEXT widget functions
+	def textsize(self, msg, fontpkg, varwidth): # returns the size needed to contain provided message
+		# Input
+		#	msg (unicode): string that contains the message for the calculation
+		#	fontpkg (fontpkg): the font to use for the calculation
+		#	varwidth (bool): Should the font be fixed or variable width
 
-		return ((maxw, maxh))
+		return fontpkg['atlas'].textsize(msg, varwidth)
 
 	def text(self, formatstring, variables, fontpkg, varwidth = True, specifiedsize=(0,0), just=u'left'):
 		# Input
@@ -444,15 +637,19 @@ class gwidget(widget):
 		if msg == '':
 			msg = ' '
 
-		maxw, maxh = self.textsize(msg, fontpkg, varwidth)
+		# If this message has already been rendered in this font and layout, reuse it
+		cachekey = (id(fontpkg), msg, varwidth, tuple(specifiedsize), just)
+		cached = self.textcache.get(cachekey, fontpkg)
+		if cached is not None:
+			self.image = cached
+			self.updatesize()
+			return True
 
-		# msglines = msg.split('\n')
-		# maxw = 0
-		# for line in msglines:
-		# 	if maxw < len(line):
-		# 		maxw = len(line)
-		# maxw = maxw * fx
-		# maxh = len(msglines) * fy
+		# Lay out and render each line in a single pass using the font's glyph atlas
+		atlas = fontpkg['atlas']
+		msglines = [ atlas.line(line, varwidth) for line in msg.split(u'\n') ]
+		maxw = max([ w for w, lineimage in msglines ])
+		maxh = len(msglines) * fy
 
 		# If a size was provided that is larger than what is required to display the text
 		# expand the image size as appropriate
@@ -461,82 +658,25 @@ class gwidget(widget):
 		maxh = maxh if maxh > height else height
 		self.image = Image.new("1", (maxw, maxh), 0)
 
-		lineimage = Image.new("1", (maxw, fy), 0)
-		for c in msg:
-
-			# If newline, move y to next line (based upon font height) and return x to beginning of line
-			if c == u'\n':
-				# Place line into image
-				if just == u'left':
-					ax = 0
-				elif just == u'center':
-					ax = (maxw-cx)/2
-
-				# if this is a character mode display then we need to be careful not to split a character across the character boundary
-				elif just == u'centerchar':
-					ax = int( fx * round((( maxw - cx) / 2) / fx))
-					# # If the number of chars is even, then we should be ok
-					# if cx % 2 == 0:
-					# 	ax = (maxw-cx)/2
-					# else:
-					# # If it's odd though we'll get split so add another character worth of space to the calculation
-					# 	ax = (maxw-cx-fx)/2
-				elif just == u'right':
-					ax = (maxw-cx)
-				self.image.paste(lineimage, (ax, cy))
-				lineimage = Image.new("1", (maxw, fy), 0)
-				cy = cy + fy
-				cx = 0
-				continue
-
-			try:
-				charimg = fontpkg[ord(c)]
-			except KeyError:
-				# Requested character does not exist in font.  Replace with '?'
-				charimg = fontpkg[ord('?')]
-
+		for cx, lineimage in msglines:
 
-			# Adjust charimg if varwidth is False
-			if not varwidth:
-				offset = (fx-charimg.size[0])/2
-				charimg = charimg.crop( (-offset,0,fx-offset,fy) )
-				charimg.load()
+			# Place line into image
+			if just == u'center':
+				ax = (maxw-cx)/2
 
-			# Paste character into frame
-			lineimage.paste(charimg, (cx,0))
-
-			# Erase space between characters
-			draw = ImageDraw.Draw(lineimage)
-			draw.rectangle((cx+charimg.size[0],0, cx+charimg.size[0], fy-1),0)
-
-			# Move to next character position
-			if varwidth:
-				cx += charimg.size[0]
+			# if this is a character mode display then we need to be careful not to split a character across the character boundary
+			elif just == u'centerchar':
+				ax = int( fx * round((( maxw - cx) / 2) / fx))
+			elif just == u'right':
+				ax = (maxw-cx)
 			else:
-				cx += fx
-
-		# # resize to exact requirement of message
-		# self.image.crop((0,0,cx-1, cy+fy))
+				ax = 0
 
-		# Place last line into image
-		if just == u'left':
-			ax = 0
-		elif just == u'center':
-			ax = (maxw-cx)/2
-
-		# if this is a character mode display then we need to be careful not to split a character across the character boundary
-		elif just == u'centerchar':
-			ax = int( fx * round((( maxw - cx) / 2) / fx))			
-			# # If the number of chars is even, then we should be ok
-			# if cx % 2 == 0:
-			# 	ax = (maxw-cx)/2
-			# else:
-			# # If it's odd though we'll get split so add another character worth of space to the calculation
-			# 	ax = (maxw-cx-fx)/2
-		elif just == u'right':
-			ax = (maxw-cx)
-		self.image.paste(lineimage, (ax, cy))
+			if lineimage is not None:
+				self.image.paste(lineimage, (ax, cy))
+			cy = cy + fy
 
+		self.textcache.put(cachekey, fontpkg, self.image)
 		self.updatesize()
 
 		return True
@@ -1021,14 +1161,8 @@ class gwidget(widget):
 			if self.direction not in [u'left',u'right',u'up',u'down']:
 				self.direction = u'left'
 
-			# Set height and width for expanded image
-			self.eheight = self.widget.size[1] if self.direction in [u'left',u'right'] else self.widget.size[1]+gap
-			self.ewidth = self.widget.size[0]+gap if self.direction in [u'left',u'right'] else self.widget.size[0]
-
-			# Update image using current index values
-			self.expanded_image = self.widget.image.copy().crop( (0,0,self.ewidth,self.eheight) )
-			self.image = self.expanded_image.copy()
-			self.image.paste( self.widget.image, (0,0) )
+			# Build the wrap-around strip the scroll is cut from
+			self.scrollstrip()
 
 			# Check to see if scrolling is needed
 			if self.direction in ['left','right']:
@@ -1056,7 +1190,9 @@ class gwidget(widget):
 
 
 		# If the widget has changed or a reset was commanded then reset the scroll to the starting position
-		if self.widget.update(reset) or reset:
+		# The widget may be shared (and updated elsewhere) so check its version instead of what update returns
+		self.widget.update(reset)
+		if self.widget.version != self.widgetversion or reset:
 			# something has changed
 			retval = True
 			self.start = time.time()
@@ -1064,22 +1200,14 @@ class gwidget(widget):
 				self.end = 0
 			else:
 				self.end = self.start + hesitatetime
-			self.image = self.widget.image.copy()
 			self.hindex = 0
 			self.vindex = 0
-			self.updatesize()
 
 			# Reset speed count
 			self.speedcount = self.speed
 
-			# Set height and width for expanded image
-			self.eheight = self.widget.size[1] if self.direction in [u'left',u'right'] else self.widget.size[1]+gap
-			self.ewidth = self.widget.size[0]+gap if self.direction in [u'left',u'right'] else self.widget.size[0]
-
-			# Update image using current index values
-			self.expanded_image = self.widget.image.copy().crop( (0,0,self.ewidth,self.eheight) )
-			self.image = self.expanded_image.copy()
-			self.image.paste( self.widget.image, (0,0) )
+			# Build the wrap-around strip the scroll is cut from
+			self.scrollstrip()
 
 			# Check to see if scrolling is needed
 			if self.direction in ['left','right']:
@@ -1122,20 +1250,11 @@ class gwidget(widget):
 			if self.vindex < 0:
 				self.vindex = self.eheight
 
-		# Reset expanded_image
-		self.expanded_image = self.widget.image.copy().crop( (0,0,self.ewidth,self.eheight) )
-
 		# Update image using current index values
 		if direction in [u'left',u'right']:
-			hregion = self.expanded_image.crop( (0,0,self.hindex,self.eheight) )
-			hbody = self.expanded_image.crop( (self.hindex,0,self.ewidth,self.eheight) )
-			self.image.paste( hbody, (0,0) )
-			self.image.paste( hregion, (self.ewidth - self.hindex, 0) )
+			self.image = self.strip.crop( (self.hindex,0,self.hindex+self.ewidth,self.eheight) )
 		elif direction in [u'up',u'down']:
-			vregion = expanded_image.crop( (0,0,self.ewidth,self.vindex) )
-			vbody = expanded_image.crop( (0,self.vindex,self.ewidth,self.eheight) )
-			self.image.paste( vbody, (0,0) )
-			self.image.paste( vregion, (0, self.eheight - self.vindex) )
+			self.image = self.strip.crop( (0,self.vindex,self.ewidth,self.vindex+self.eheight) )
 
 		if hesitatetype == u'onloop' and ( (self.hindex == 0 and self.direction in [u'left',u'right']) or (self.vindex == 0 and self.direction in [u'up',u'down'])):
 			self.start = time.time()
@@ -1143,6 +1262,27 @@ class gwidget(widget):
 
 		return True
 
+	def scrollstrip(self):
+		# Expand the widget's image by the gap and lay two copies of it end to end in the scroll
+		# direction.  Any position of the scroll is then a single window cut from the strip.
+		# Only needs to be rebuilt when the content of the widget changes
+
+		# Set height and width for expanded image
+		self.eheight = self.widget.size[1] if self.direction in [u'left',u'right'] else self.widget.size[1]+self.gap
+		self.ewidth = self.widget.size[0]+self.gap if self.direction in [u'left',u'right'] else self.widget.size[0]
+
+		expanded_image = self.widget.image.crop( (0,0,self.ewidth,self.eheight) )
+		if self.direction in [u'left',u'right']:
+			self.strip = expanded_image.crop( (0,0,self.ewidth*2,self.eheight) )
+			self.strip.paste( expanded_image, (self.ewidth,0) )
+		else:
+			self.strip = expanded_image.crop( (0,0,self.ewidth,self.eheight*2) )
+			self.strip.paste( expanded_image, (0,self.eheight) )
+
+		self.image = expanded_image
+		self.updatesize()
+		self.widgetversion = self.widget.version
+
 class gwidgetText(gwidget):
 	def __init__(self, formatstring, fontpkg, variabledict={ }, variables =[], varwidth = True, size=(0,0), just=u'left'):
 		super(gwidgetText, self).__init__(variabledict)
@@ -1194,6 +1334,73 @@ class gwidgetScroll(gwidget):
 		self.scroll(widget, direction, distance, speed, gap, hesitatetype, hesitatetime,threshold,reset)
 
 
+def earliest(times): # Returns the earliest of a list of times ignoring any that are None (or None if they all are)
+	times = [ t for t in times if t is not None ]
+	return min(times) if times else None
+
+class compiledconditional(object): # A sequence or widget conditional compiled once at load time
+	# Matches db['key'] and dbp['key'] references within a conditional
+	dbref = re.compile(r"""\b(dbp?)\s*\[\s*(?:u?'([^'\\]*)'|u?"([^"\\]*)")\s*\]""")
+	anydbref = re.compile(r"\bdbp?\s*\[")
+	names = set(['db', 'dbp', 'True', 'False', 'None'])
+	missing = object()
+
+	def __init__(self, conditional):
+		# Input
+		#	conditional (unicode) -- A string containing an evaluable boolean logic statement
+
+		# This is NOT a safe routine.  Make sure that any input sent to this function is from a trusted source
+
+		self.conditional = conditional
+		self.dbkeys = ()		# Keys of db that the conditional reads
+		self.dbpkeys = ()		# Keys of dbp that the conditional reads
+		self.tracked = False	# True if the result only depends upon dbkeys and dbpkeys
+		self.values = None		# Values of the keys at the last evaluation
+		self.result = False		# Result of the last evaluation
+
+		try:
+			self.code = compile(conditional, '<conditional>', 'eval')
+		except:
+			logging.warning('Unable to compile conditional {0}'.format(conditional))
+			self.code = None
+			self.tracked = True
+			self.values = ((),())
+			return
+
+		dbkeys = []
+		dbpkeys = []
+		refs = self.dbref.findall(conditional)
+		for name, k1, k2 in refs:
+			key = k1 or k2
+			keys = dbkeys if name == 'db' else dbpkeys
+			if key not in keys:
+				keys.append(key)
+		self.dbkeys = tuple(dbkeys)
+		self.dbpkeys = tuple(dbpkeys)
+
+		# Only track conditionals whose keys are all literals and that do not depend upon anything else (function calls, time, etc)
+		if len(refs) == len(self.anydbref.findall(conditional)) and set(self.code.co_names) <= self.names:
+			self.tracked = True
+
+	def __str__(self):
+		return self.conditional
+
+	def evaluate(self, db, dbp):
+		# Returns the value of the conditional.  Only re-evaluates it if one of the keys it reads has changed since the last call
+
+		if self.tracked:
+			values = (tuple([ db.get(k, self.missing) for k in self.dbkeys ]), tuple([ dbp.get(k, self.missing) for k in self.dbpkeys ]))
+			if values == self.values:
+				return self.result
+			self.values = values
+
+		try:
+			self.result = eval(self.code, globals(), { 'db': db, 'dbp': dbp })
+		except:
+			# Could not evaluate conditional so returning False
+			self.result = False
+		return self.result
+
 class sequence(object): # Holds a sequence of widgets to display on the screen in turn
 	def __init__(self, name, conditional, db, dbprevious, coolingperiod, minimum, coordinates): # initialize class
 		# Input
@@ -1214,6 +1421,7 @@ class sequence(object): # Holds a sequence of widgets to display on the screen i
 		self.currentwidget = 0				# Marks the index of the current widget
 		self.minimum = minimum				# When this sequence activates, keep in active for a least minimum seconds
 		self.expires = 0					# Time that this sequence can be allowed to go inactive
+		self.changed = True					# Whether the image of the widget returned by the last call to get may have changed
 
 		return
 
@@ -1232,10 +1440,13 @@ class sequence(object): # Holds a sequence of widgets to display on the screen i
 
 	def evalconditional(self, conditional): # Evaluate the conditional statement
 		# Input
-		#	conditional (unicode) -- A string containing an evaluable boolean logic statement
+		#	conditional (unicode or compiledconditional) -- A string containing an evaluable boolean logic statement or a precompiled version of one
 
 		# This is NOT a safe routine.  Make sure that any input sent to this function is from a trusted source
 
+		if isinstance(conditional, compiledconditional):
+			return conditional.evaluate(self.db, self.dbp)
+
 		db = self.db
 		dbp = self.dbp
 
@@ -1245,10 +1456,31 @@ class sequence(object): # Holds a sequence of widgets to display on the screen i
 			# Could not evaluate conditional so returning False
 			return False
 
- 	def get(self, restart=False): # Return current widget (or None) if none are active
+	def nextchange(self, widget, now): # Returns the earliest time that this sequence could change on its own or None if it only changes when system variables change
+		# Input
+		#	widget (widget) -- The widget this sequence returned for the current frame or None if the sequence was not active
+
+		times = [ t for t in (self.expires, self.coolingexpires) if t > now ]
+
+		# Conditionals that depend upon more than system variables are checked every second
+		conditionals = [ self.conditional ] + [ c for w,d,c in self.widgets ]
+		for c in conditionals:
+			if not isinstance(c, compiledconditional) or not c.tracked:
+				times.append(math.floor(now)+1)
+				break
+
+		if widget is not None:
+			times.append(max(self.end, now))
+			times.append(widget.nextchange(now))
+
+		return earliest(times)
+
+	def get(self, restart=False): # Return current widget (or None) if none are active
 		# Input
 		#	restart (bool) -- If True resets the sequence to the first widget on the list
 
+		self.changed = True
+
 		# Evaluate sequence conditional and check for cooling period.
 		if self.expires < time.time() and (not self.evalconditional(self.conditional) or self.coolingexpires > time.time()):
 			return None
@@ -1288,13 +1520,28 @@ class sequence(object): # Holds a sequence of widgets to display on the screen i
 			return None
 		else:
 			# If current widget is active and has not expired, then return it
-			widget.update()
+			self.changed = widget.update()
 			return widget
 
 class display_controller(object):
 	def __init__(self, size):
 		self.sequences = []
 		self.size = size
+		self.dependents = { }		# System variable name -> widgets whose content depends upon it
+		self.dbsnapshot = { }		# Values of the system variables as of the last frame
+		self.changedvars = set()	# System variables that changed since the previous frame
+
+		self.frame = None			# The last image returned by next
+		self.frameactive = None		# The widgets (and their positions) that the last frame was composed from
+		self.framewidgets = [ ]		# The widget returned by each sequence for the last frame (None if not active)
+
+		# Pipe used to wake a thread waiting for the next frame (see sleep and wake)
+		self.wakepipe = os.pipe()
+		for fd in self.wakepipe:
+			fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+		self.generation = 0			# Incremented each time next returns an image that differs from the previous one
+		self.changed = True			# Whether the last image returned by next differs from the one before it
+		self.dirtybox = None		# Bounding box of the pixels that changed in the last image returned by next (None if unchanged)
 
 	def load(self, file, db, dbp,): # Load config file and initialize sequences
 		# Input
@@ -1307,6 +1554,11 @@ class display_controller(object):
 		self.pages = None
 		self.widgets = { }
 		self.sequences = []
+		self.dependents = { }
+		self.dbsnapshot = { }
+		self.changedvars = set()
+		self.frame = None
+		self.frameactive = None
 		self.errwidgets = { }
 		self.defaultfontpkg = None
 
@@ -1506,6 +1758,9 @@ class display_controller(object):
 
 					widget.add(widtoadd, (x,y))
 
+			# Record which variables the widget depends upon so that it only gets updated when one of them changes
+			self.watch(widget)
+
 			# Add effect if requested
 			effect = v['effect'] if 'effect' in v else None
 			if effect != None:
@@ -1551,17 +1806,65 @@ class display_controller(object):
 			# Add widget to widget list
 			self.widgets[k] = widget
 
+	def watch(self, widget): # Add widget to the variable dependency index
+		deps = widget.dependencies()
+		if deps is None:
+			return
+		for name in deps:
+			self.dependents.setdefault(name, []).append(widget)
+		widget.watched = True
+		widget.stale = True
+
+	def findchanges(self): # Mark the widgets that depend upon any system variable that changed since the last frame
+		changed = set()
+		snapshot = self.dbsnapshot
+		for k, v in self.db.iteritems():
+			if k not in snapshot or snapshot[k] != v:
+				changed.add(k)
+		for k in snapshot:
+			if k not in self.db:
+				changed.add(k)
+
+		if changed:
+			self.dbsnapshot = dict(self.db)
+			for k in changed:
+				for widget in self.dependents.get(k, ()):
+					widget.stale = True
+
+		self.changedvars = changed
+		return changed
+
 	def next(self): # Compute and return the next image to display
+		# Sets changed, generation and dirtybox to describe how the returned image differs from the previous one
+		# If nothing changed the previous image is returned again so it must not be modified by the caller
+
 		active = []
 		img = None
+		changed = False
+
+		# There are no system variables to check until load has been called
+		if hasattr(self, 'db'):
+			self.findchanges()
 
+		self.framewidgets = [ ]
 		for s in self.sequences:
 			w = s.get()
+			self.framewidgets.append(w)
 			if w != None:
 				active.append((w,s.coordinates))
+				if s.changed:
+					changed = True
 				# If sequence does not have an active coolingperiod timer set then set one
 				if s.coolingexpires < time.time():
 					s.coolingexpires = s.coolingperiod + time.time()
+
+		# If the same widgets are showing in the same places and none of them changed, the frame has not changed
+		if not changed and self.frame is not None and active == self.frameactive:
+			self.changed = False
+			self.dirtybox = None
+			return self.frame
+		self.frameactive = active
+
 		img = None
 		for wid in active:
 			if not img:
@@ -1587,9 +1890,55 @@ class display_controller(object):
 			x,y = self.size
 			img = img.crop( (0,0,x,y))
 
+		# Compare with the previous frame to see what changed
+		prev = self.frame
+		if prev is None or prev.size != img.size or prev.mode != img.mode:
+			self.dirtybox = (0,0,img.size[0],img.size[1])
+		elif prev.tobytes() == img.tobytes():
+			self.dirtybox = None
+		else:
+			self.dirtybox = ImageChops.difference(prev, img).getbbox()
+
+		if self.dirtybox is None:
+			self.changed = False
+			return prev
+
+		self.changed = True
+		self.generation += 1
+		self.frame = img
+
 		# Return next valid image
 		return img
 
+	def nextupdate(self): # Returns the earliest time that the display could change without a change to the system variables (None if it can not)
+		now = time.time()
+		return earliest([ s.nextchange(w, now) for s, w in zip(self.sequences, self.framewidgets) ])
+
+	def sleep(self, timeout): # Wait up to timeout seconds for wake to be called.  Returns True if woken
+		try:
+			r, w, x = select.select([ self.wakepipe[0] ], [], [], max(timeout, 0))
+		except select.error:
+			# Interrupted (e.g. by a signal)
+			return False
+
+		if not r:
+			return False
+
+		try:
+			while os.read(self.wakepipe[0], 4096):
+				pass
+		except OSError:
+			# Pipe is empty
+			pass
+		return True
+
+	def wake(self): # Wake a thread waiting in sleep (e.g. because the system variables have been updated)
+		try:
+			os.write(self.wakepipe[1], b'.')
+		except OSError:
+			# Pipe is full so a wake is already pending
+			pass
+
 	def loadsequences(self, sequences):
 
 		for value in sequences:
@@ -1602,7 +1951,7 @@ class display_controller(object):
 
 #			logging.debug('Loading sequence {0}'.format(name))
 
-			newseq = sequence(name,conditional,self.db,self.dbp, coolingperiod, minimum, coordinates)
+			newseq = sequence(name,compiledconditional(conditional),self.db,self.dbp, coolingperiod, minimum, coordinates)
 			self.sequences.append(newseq)
 			canvases = value['canvases'] if 'canvases' in value else []
 			if canvases:
@@ -1613,7 +1962,7 @@ class display_controller(object):
 					if cname and duration and cconditional:
 						widget = self.widgets[cname] if cname in self.widgets else None
 						if widget:
-							newseq.add(widget,duration, cconditional)
+							newseq.add(widget,duration, compiledconditional(cconditional))
 						else:
 							logging.warning('Trying to add widget {0} to sequence {1} but widget was not found'.format(cname, name))
 
@@ -1640,8 +1989,33 @@ def processevent(events, starttime, prepost, db, dbp):
 			elif prepost in ['post']:
 				dbp[var] = val
 
+def selftest():
+	# Check that a widget shared by two canvases is repainted in both when it changes while only one of them is being updated
+	# Returns True if both canvases end up showing the new text
+	fontpkg = fonts.bmfont.bmfont(u'latin1_5x8_fixed.fnt').fontpkg
+	db = { u'title': u'One' }
+	text = gwidgetText(u'{0}', fontpkg, db, [ u'title' ], size=(40,8))
+	showing = gwidgetCanvas( (40,8) ).add(text, (0,0))
+	hidden = gwidgetCanvas( (40,8) ).add(text, (0,0))
+	showing.update(True)
+	hidden.update(True)
+
+	# Only the showing canvas is updated while the variable changes
+	db[u'title'] = u'Two'
+	showing.update()
+	showing.update()
+
+	# When the hidden canvas is shown again it must pick up the change
+	changed = hidden.update()
+	expected = gwidgetText(u'Two', fontpkg, size=(40,8)).image
+	return changed and showing.image.tobytes() == expected.tobytes() and hidden.image.tobytes() == expected.tobytes()
+
 if __name__ == '__main__':
 
+	if not selftest():
+		print u'A widget shared by two canvases was not repainted in both'
+		sys.exit(1)
+
 	import graphics as g
 	import moment
 
@@ -0,0 +1,172 @@
+#!/usr/bin/python
+# coding: UTF-8
+
+# Recording stand in for RPi.GPIO
+#
+# Lets the parallel display drivers (hd44780, winstar_weg) run on a machine without
+# GPIO pins so that they can be tested and benchmarked.  Every output call is counted
+# and every change of a pin is recorded.  decode() turns the recording back into the
+# nibbles the display would have latched.
+#
+# Call install() before importing the drivers so that their "import RPi.GPIO" finds it.
+
+import sys, types
+
+BCM = 11
+BOARD = 10
+OUT = 0
+IN = 1
+LOW = 0
+HIGH = 1
+
+mode = None
+pins = { }		# Current value of each pin that has been set up
+log = [ ]		# (pin, value) for every change of a pin's value
+snapshot = { }	# Value of each pin when the recording was last reset
+calls = 0		# Number of output calls made
+recording = True
+
+def setmode(m):
+	global mode
+	mode = m
+
+def setwarnings(flag):
+	pass
+
+def setup(channel, direction, initial=LOW, pull_up_down=None):
+	for c in (channel if isinstance(channel, (list, tuple)) else [ channel ]):
+		pins[c] = 1 if initial else 0
+
+def output(channel, value):
+	# Accepts a single channel or a list of channels (with either one value or one value per channel)
+	global calls
+	calls += 1
+
+	if isinstance(channel, (list, tuple)):
+		values = value if isinstance(value, (list, tuple)) else [ value ] * len(channel)
+		if len(values) != len(channel):
+			raise ValueError(u'Number of channels != number of values')
+	else:
+		channel = [ channel ]
+		values = [ value ]
+
+	for c, v in zip(channel, values):
+		if c not in pins:
+			raise RuntimeError(u'The GPIO channel has not been set up as an OUTPUT')
+		v = 1 if v else 0
+		if pins[c] != v:
+			pins[c] = v
+			if recording:
+				log.append( (c, v) )
+
+def input(channel):
+	return pins.get(channel, 0)
+
+def cleanup(channel=None):
+	pins.clear()
+
+def reset():
+	# Forget everything that has been recorded
+	# The pin values are kept so that decode knows the state of pins that do not change again
+	global calls, snapshot
+	del log[:]
+	calls = 0
+	snapshot = dict(pins)
+
+def decode(pin_e, pin_rs, pins_db):
+	# Returns (rs, nibble) for every falling edge of the enable pin using the pin values at the time of the edge
+	# pins_db lists the data pins from D4 to D7
+	state = dict(snapshot)
+	nibbles = [ ]
+	for c, v in log:
+		if c == pin_e and v == 0 and state.get(pin_e):
+			nibble = 0
+			for bit, p in enumerate(pins_db):
+				if state.get(p):
+					nibble |= 1 << bit
+			nibbles.append( (state.get(pin_rs, 0), nibble) )
+		state[c] = v
+	return nibbles
+
+def selftest():
+	# Check that decode reads back the nibbles written before and after a reset
+	# Returns True if they all match
+	pin_e, pin_rs, pins_db = 1, 2, [ 3, 4, 5, 6 ]
+	cleanup()
+	reset()
+	setup([ pin_e, pin_rs ] + pins_db, OUT)
+
+	def writebyte(value, rs):
+		for nibble in (value >> 4, value & 0x0F):
+			output([ pin_rs ] + pins_db, [ rs ] + [ (nibble >> bit) & 1 for bit in range(4) ])
+			output(pin_e, HIGH)
+			output(pin_e, LOW)
+
+	writebyte(0x41, 1)
+	ok = decode(pin_e, pin_rs, pins_db) == [ (1, 0x4), (1, 0x1) ]
+
+	# RS and D4 are already high so they are not written again for the high nibble of 0x94
+	reset()
+	writebyte(0x94, 1)
+	ok = ok and decode(pin_e, pin_rs, pins_db) == [ (1, 0x9), (1, 0x4) ]
+
+	cleanup()
+	reset()
+	return ok
+
+def install():
+	# Make "import RPi.GPIO" return this module
+	rpi = types.ModuleType('RPi')
+	rpi.GPIO = sys.modules[__name__]
+	sys.modules['RPi'] = rpi
+	sys.modules['RPi.GPIO'] = sys.modules[__name__]
+
+
+if __name__ == '__main__':
+
+	import time, getopt
+	from PIL import Image, ImageDraw
+
+	try:
+		opts, args = getopt.getopt(sys.argv[1:],"hr:c:",["row=","col=","frames="])
+	except getopt.GetoptError:
+		print 'fakegpio.py -r <rows> -c <cols> --frames <number of frames>'
+		sys.exit(2)
+
+	rows = 32
+	cols = 100
+	frames = 20
+	for opt, arg in opts:
+		if opt == '-h':
+			print 'fakegpio.py -r <rows> -c <cols> --frames <number of frames>'
+			sys.exit()
+		elif opt in ("-r", "--row"):
+			rows = int(arg)
+		elif opt in ("-c", "--col"):
+			cols = int(arg)
+		elif opt in ("--frames"):
+			frames = int(arg)
+
+	if not selftest():
+		print u'decode did not return the nibbles that were written'
+		sys.exit(1)
+
+	install()
+	import winstar_weg
+
+	# Benchmark how fast full frames can be sent to a Winstar graphic display without the timing of real pins
+	lcd = winstar_weg.winstar_weg(rows, cols, enable_duration=0)
+	recording = False
+	images = [ ]
+	for i in range(2):
+		img = Image.new("1", (cols, rows))
+		ImageDraw.Draw(img).rectangle( (i, i, cols-1-i, rows-1-i), outline=1)
+		images.append(img)
+
+	reset()
+	start = time.time()
+	for i in range(frames):
+		lcd.update(images[i%2])
+	elapsed = time.time() - start
+
+	print u'{0} frames in {1:.3f}s ({2:.1f}ms per frame), {3} GPIO output calls per frame'.format(frames, elapsed, elapsed*1000/frames, calls/frames)
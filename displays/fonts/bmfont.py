@@ -15,6 +15,7 @@ class bmfont:
 	def __init__(self,fontfile):
 		self.fontpkg = { } # Holds an image of each font character
 		self.imglookup = { } # Holds image key to perform a reverse lookup of an image back to the character it represents
+		self.celllookup = { } # Same as imglookup but for 5x8 images keyed by a 40 bit integer (see graphics.getcells)
 		self.chardata = { } # Holds position and size data for each character on sprite sheet
 
 		# Read file
@@ -139,6 +140,18 @@ class bmfont:
 				data = tuple(list(img.convert("1").getdata()))
 				self.imglookup[data] = k
 
+		# Pack the 5x8 images into integers (one bit per pixel, top left pixel in the most significant bit)
+		# so that character displays can identify cells without building tuples of pixels
+		for data, k in self.imglookup.iteritems():
+			if len(data) == 40:
+				key = 0
+				for p in data:
+					key = (key << 1) | (1 if p else 0)
+				self.celllookup[key] = k
+
+		# Pack the glyphs into an atlas used to lay out and render whole lines of text
+		self.atlas = glyphatlas(self.fontpkg)
+		self.fontpkg['atlas'] = self.atlas
 
 		# except IOError:
 		# 	print u'Sprite file {0} was not found.'.format(self.file)
@@ -161,3 +174,83 @@ class bmfont:
 			v = v.strip()
 			d[k] = v
 		return d
+
+class glyphatlas:
+	# All of the glyphs of a font packed into a single 8 bit image (one byte per pixel) with
+	# the variable width glyphs first followed by the fixed pitch (centered) versions.
+	# Each glyph's rows are sliced out of the atlas once so that a line of text can be
+	# produced by joining rows together instead of pasting one character at a time.
+
+	def __init__(self, fontpkg):
+		(fx, fy) = fontpkg['size']
+		self.size = (fx, fy)
+
+		self.widths = { } # Variable width of each character
+		self.offsets = { } # Offset used to center each character within a fixed pitch cell
+		self.varx = { } # Position of each variable width glyph within the atlas
+		self.fixx = { } # Position of each fixed pitch glyph within the atlas
+
+		codes = sorted([ k for k in fontpkg if type(k) is int ])
+		for k in codes:
+			w = fontpkg[k].size[0]
+			self.widths[k] = w
+			self.offsets[k] = (fx-w)/2
+
+		# Lay out the atlas
+		x = 0
+		for k in codes:
+			self.varx[k] = x
+			x += self.widths[k]
+		for k in codes:
+			self.fixx[k] = x
+			x += fx
+		self.width = x
+
+		self.image = Image.new("L", (max(self.width,1), fy), 0)
+		for k in codes:
+			img = fontpkg[k]
+			w = self.widths[k]
+			offset = self.offsets[k]
+			if w > 0:
+				self.image.paste(img.crop( (0,0,w,fy) ).convert("1"), (self.varx[k], 0))
+			self.image.paste(img.crop( (-offset,0,fx-offset,fy) ).convert("1"), (self.fixx[k], 0))
+		self.data = self.image.tobytes()
+
+		# (width, rows) for each glyph where rows holds one byte string per pixel row
+		stride = self.image.size[0]
+		self.varglyphs = { }
+		self.fixglyphs = { }
+		for k in codes:
+			self.varglyphs[k] = (self.widths[k], self.rows(self.varx[k], self.widths[k], stride))
+			self.fixglyphs[k] = (fx, self.rows(self.fixx[k], fx, stride))
+
+	def rows(self, x, w, stride):
+		fy = self.size[1]
+		return tuple([ self.data[r*stride+x:r*stride+x+w] for r in range(fy) ])
+
+	def layout(self, line, varwidth):
+		# Returns the width of a single line of text and the glyphs needed to draw it
+		# Characters that do not exist in the font are replaced with '?'
+		table = self.varglyphs if varwidth else self.fixglyphs
+		glyphs = [ table.get(ord(c)) or table[ord('?')] for c in line ]
+		return (sum([ g[0] for g in glyphs ]), glyphs)
+
+	def textsize(self, msg, varwidth):
+		# returns the size needed to contain provided message
+		maxw = 0
+		lines = msg.split(u'\n')
+		for line in lines:
+			w, glyphs = self.layout(line, varwidth)
+			if w > maxw:
+				maxw = w
+		return (maxw, len(lines)*self.size[1])
+
+	def line(self, line, varwidth):
+		# Render a single line of text.  Returns the width of the line and an 8 bit image
+		# of it (or None if the line is empty)
+		w, glyphs = self.layout(line, varwidth)
+		if w == 0:
+			return (0, None)
+
+		data = b''.join(map(b''.join, zip(*[ g[1] for g in glyphs ])))
+		return (w, Image.frombytes("L", (w, self.size[1]), data))
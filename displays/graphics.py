@@ -3,7 +3,7 @@
 
 # Base class to provide graphics primitives
 # Written by: Ron Ritchey
-import sys, copy, math
+import sys, copy, math, binascii
 from PIL import Image
 from PIL import ImageDraw
 
@@ -72,51 +72,67 @@ def invertbits(byte):
 	retval = retval >> 1
 	return retval
 
-def getframe(image,x,y,width,height):
-	# Returns an array of arrays
-	# [
-	#   [ ], # Array of bytes for line 0
-	#   [ ]  # Array of bytes for line 1
-	#				 ...
-	#   [ ]  # Array of bytes for line n
-	# ]
+def packframe(image):
+	# Returns the image packed into a bytearray one page (8 rows) at a time
+	# Each page holds one byte per column with the top row of the page in the least significant bit
+	# Pages are stored in order so byte (page*width)+column holds rows page*8 to page*8+7 of column
 
-	# Select portion of image to work with
 	img = image.convert("1")
-	#img.crop( (x,y, width, height) )
-
-
 	width, height = img.size
-	bheight = int(math.ceil(height / 8.0))
-	imgdata = list(img.getdata())
-
-
-	retval = []	# The variable to hold the return value (an array of byte arrays)
-	retline = [0]*width # Line to hold the first byte of image data
-	bh = 0 # Used to determine when we've consumed a byte worth of the line
-
-	# Perform a horizontal iteration of the image data
-	for i in range(0,height):
-		for j in range(0,width):
-			# if the value is true then mask a bit into the byte within retline
-			if imgdata[(i*width)+j]:
-				try:
-					retline[j] |= 1<<bh
-				except IndexError as e:
-					# WTF
-					print "width = {0}".format(width)
-					raise e
-		# If we've written a full byte, start a new retline
-		bh += 1
-		if bh == 8: # We reached a byte boundary
-			bh = 0
-			retval.append(retline)
-			retline = [0]*width
-	if bh > 0:
-		retval.append(retline)
-
+	pages = int(math.ceil(height / 8.0))
+	if width == 0 or pages == 0:
+		return bytearray()
+
+	# Pad to a whole number of pages and turn each column into a row with the bottom of the image first.
+	# PIL then packs each row 8 pixels to a byte (most significant bit first) which leaves each column's pages
+	# as consecutive bytes in reverse order with the top row of each page in its least significant bit
+	img = img.crop( (0,0,width,pages*8) ).transpose(Image.TRANSPOSE).transpose(Image.FLIP_LEFT_RIGHT)
+	data = img.tobytes()
+
+	# Regroup from column-major to page-major
+	retval = bytearray()
+	for p in range(pages-1,-1,-1):
+		retval += data[p::pages]
 	return retval
 
+def getframe(image,x,y,width,height):
+	# Returns an array of bytearrays
+	# [
+	#   bytearray, # bytes for line 0
+	#   bytearray  # bytes for line 1
+	#				 ...
+	#   bytearray  # bytes for line n
+	# ]
+	# Each line is 8 pixels high with one byte per column (see packframe)
+
+	width = image.size[0]
+	data = packframe(image)
+	return [ data[i:i+width] for i in range(0, len(data), width) ]
+
+def getcells(image, cols, rows, cellwidth=5, cellheight=8):
+	# Returns each cellwidth x cellheight cell of the image (row by row) packed into an integer
+	# Pixels are packed a row at a time with the top left pixel of the cell in the most significant bit
+	# e.g. for a 5x8 cell the top row is bits 39-35 and the bottom row is bits 4-0
+
+	width = cols*cellwidth
+	img = image.convert("1").crop( (0,0,width,rows*cellheight) )
+	data = img.tobytes()
+
+	stride = (width+7)/8 # PIL pads each row to a whole number of bytes
+	pad = stride*8 - width
+	mask = (1<<cellwidth)-1
+
+	cells = [0]*(cols*rows)
+	for y in range(rows*cellheight):
+		# Turn the row into one large integer and then slice each cell's bits out of it
+		line = int(binascii.hexlify(data[y*stride:(y+1)*stride]), 16) >> pad
+		base = (y/cellheight)*cols
+		shift = width
+		for c in range(base, base+cols):
+			shift -= cellwidth
+			cells[c] = (cells[c] << cellwidth) | ((line >> shift) & mask)
+	return cells
+
 def scrollbuffer(image, direction=u'left', distance=1):
 	direction = direction.lower()
 
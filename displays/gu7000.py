@@ -8,8 +8,9 @@
 
 from __future__ import unicode_literals
 
-import time, math, logging
+import time, math, logging, threading, Queue
 import lcd_display_driver
+import timing
 import fonts
 import graphics as g
 from PIL import Image, ImageChops
@@ -20,22 +21,47 @@ import serial
 
 class _GU7000():
 
-    def __init__(self, port, baudrate, width=140, height=32):
-        self.flash_buffer_every_bytes = 4
+    # How long to wait for the display to become ready before sending anyway
+    CTS_TIMEOUT = 1.0
+
+    def __init__(self, port, baudrate, width=140, height=32, flowcontrol='cts', chunksize=4):
+        # flowcontrol
+        #   'cts' -- Wait for the display to raise CTS before each chunk of chunksize bytes.  Waits sleep instead of spinning
+        #   'rtscts' -- Let the serial port hardware hold off sending while CTS is low.  Use when the UART's CTS pin is connected
+        self.flash_buffer_every_bytes = chunksize
+        self.flowcontrol = flowcontrol
         self.port = port
         self.baudrate = baudrate
-        self.serial = serial.Serial(rtscts=False)
+        self.serial = serial.Serial(rtscts=(flowcontrol == 'rtscts'))
         # self.serial.write_timeout = 0
         # self.serial.inter_byte_timeout = 0
         self.width = width
         self.height = height
 
+        # Packets are queued and written to the port by the writer thread so that the next packet of a frame can be
+        # built while the previous one is being sent.  update waits for the queue to drain before returning
+        self.queue = Queue.Queue()
+        self.writer = None
+
+        # Statistics
+        self.busywaits = 0 # Number of times the display was not ready for the next chunk
+        self.busytime = 0.0 # Seconds spent waiting for the display to be ready
+
     def open(self):
         self.serial.baudrate = self.baudrate
         self.serial.port = self.port
         self.serial.open()
 
+        self.writer = threading.Thread(target=self.writeloop)
+        self.writer.daemon = True
+        self.writer.start()
+
     def close(self):
+        if self.writer is not None:
+            self.drain()
+            self.queue.put(None)
+            self.writer.join()
+            self.writer = None
         if self.serial.is_open == True:
             self.serial.close()
 
@@ -44,14 +70,46 @@ class _GU7000():
             yield lst[i:i + n]
 
     def write_data(self, data):
-        # self.serial.write(data)
-        for x in list(self.chunkData(data, self.flash_buffer_every_bytes)):
-            while not self.serial.cts:
-                pass
-            self.serial.write(x)
-            while not self.serial.cts:
-                pass
-            self.serial.flushOutput()
+        # Queue data to be sent to the display
+        self.queue.put(bytes(data))
+
+    def drain(self):
+        # Wait until everything queued has been sent
+        self.queue.join()
+
+    def writeloop(self):
+        while True:
+            data = self.queue.get()
+            try:
+                if data is None:
+                    return
+                for x in self.chunkData(data, self.flash_buffer_every_bytes):
+                    self.waitready()
+                    self.serial.write(x)
+
+                    # Wait for the chunk to leave the UART so that CTS reflects whether the display has room for the next one
+                    if self.flowcontrol != 'rtscts':
+                        self.serial.flush()
+            except Exception:
+                logging.exception(u'Error writing to GU7000')
+            finally:
+                self.queue.task_done()
+
+    def waitready(self):
+        # Wait for the display to signal (with CTS) that it can accept more data
+        if self.flowcontrol == 'rtscts' or self.serial.cts:
+            return
+
+        self.busywaits += 1
+        start = time.time()
+        pause = 0.0001
+        while not self.serial.cts:
+            if time.time() - start > self.CTS_TIMEOUT:
+                logging.warning(u'GU7000 has not been ready for {0} seconds.  Sending anyway'.format(self.CTS_TIMEOUT))
+                break
+            time.sleep(pause)
+            pause = min(pause * 2, 0.002)
+        self.busytime += time.time() - start
 
     def set_brightness(self, brightness):
         b = chr(max(int(min(brightness * 8, 8)), 1))
@@ -94,17 +152,13 @@ class _GU7000():
         self.write_data(packet)
 
     def show_pil_image(self, image, imgWidth, imgHeight):
-        image_data = image.getdata()
-        buf = bytearray(imgWidth * imgHeight / 8)
-        threshold = 1
-        for x in range(0, imgWidth):
-            for y in range(0, imgHeight / 8):
-                val = 0
-                for i in range(0, 8):
-                    val = (1 if i == 0 else (val + 1)) if image_data[ x + (y * 8 + i) * imgWidth] >= threshold else val
-                    if i < 7:
-                        val = val + val
-                buf[x * (imgHeight / 8) + y] = val
+        # The display wants the image column by column with 8 rows to a byte (top row in the most significant bit).
+        # Transposing the image turns each column into a row which PIL then packs 8 pixels to a byte in that order
+        img = image.crop((0, 0, imgWidth, (imgHeight / 8) * 8))
+        if img.mode != '1':
+            threshold = 1
+            img = img.convert('L').point(lambda v: 255 if v >= threshold else 0, '1')
+        buf = bytearray(img.transpose(Image.TRANSPOSE).tobytes())
         self.show_raw_image(buf, imgWidth=imgWidth, imgHeight=imgHeight / 8)
 
     def sleep(self):
@@ -117,14 +171,19 @@ class _GU7000():
         self.write_data(b"\x0C")
 
     def delayMicroseconds(self, microseconds):
-        seconds = microseconds / 1000000.0  # divide microseconds by 1 million for seconds
-        time.sleep(seconds)
+        timing.delayMicroseconds(microseconds)
 
 
 
 class gu7000():
 
-    def __init__(self, rows=32, cols=140, port='/dev/ttyAMA0', baudrate=115200):
+    # Largest horizontal shift between frames that will be sent as a hardware scroll
+    MAXSHIFT = 8
+
+    def __init__(self, rows=32, cols=140, port='/dev/ttyAMA0', baudrate=115200, flowcontrol='cts', chunksize=4, memorywidth=0):
+        # memorywidth is the number of columns of display memory (the visible area plus the hidden area).  When it is
+        # wider than the display, frames that are the previous frame moved left (e.g. a scrolling line with the rest of
+        # the screen blank) are sent as a hardware scroll plus the newly exposed columns.  0 disables hardware scrolling
         self.screensaverDelay = 60.0
         self.firstEmptyFrameDate = None
         self.emptyFrameCounter = 0
@@ -137,13 +196,19 @@ class gu7000():
         self.rows = rows
         self.cols = cols
 
+        self.memorywidth = memorywidth if memorywidth > cols else 0
+        self.origin = 0 # Column of display memory shown at the left edge of the display
+
+        # Statistics
+        self.hwscrolls = 0 # Frames sent as a hardware scroll
+
         self.fb = [[]]
 
         #Initialize the default font
         font = fonts.bmfont.bmfont('latin1_5x8_fixed.fnt')
         self.fp = font.fontpkg
 
-        self.device = _GU7000(port=self.port, baudrate=self.baudrate, width=self.cols, height=self.rows)
+        self.device = _GU7000(port=self.port, baudrate=self.baudrate, width=self.cols, height=self.rows, flowcontrol=flowcontrol, chunksize=chunksize)
         self.device.open()
         self.device.reset()
         self.device.clear_display()
@@ -163,11 +228,8 @@ class gu7000():
         self.update(textwidget.image)
 
     def isPILImageEmpty(self, image):
-        data = image.getdata()
-        for i in range(0, len(data)):
-            if data[i] != 0:
-                return False
-        return True
+        # getbbox returns None when every pixel is zero
+        return image.getbbox() is None
 
     def disable_screensaver(self):
         if self.isScreenSaverActive:
@@ -179,51 +241,84 @@ class gu7000():
     def update(self, image):
         newFrame = image.crop((0, 0, self.cols, self.rows))
 
-        if self.previousFrame is not None:
-            diff_image = ImageChops.logical_xor(newFrame, self.previousFrame)
-
-            diff_data = diff_image.getdata()
-            start_y = 0
-            end_y = 0
-            for i in range(0, len(diff_data)):
-                if diff_data[i] != 0:
-                    start_y = int(i) / int(self.cols)
-                    break
-            if start_y != 0:
-                for i in reversed(range(0, len(diff_data))):
-                    if diff_data[i] != 0:
-                        end_y = int(i) / int(self.cols)
-                        break
-                if start_y != 0 and end_y != 0:
-                    start_y = int(round(float(start_y) / 8)) * 8
-                    self.previousFrame = newFrame
-                    if ((end_y-start_y) % 8 !=0):
-                        end_y = start_y + (8 * int(math.ceil(float(end_y-start_y) / float(8))))
-                    diff_image = newFrame.crop((0, start_y, self.cols, end_y))
-                    self.device.move_cursor(0, start_y)
-                    self.device.show_pil_image(diff_image, self.cols, diff_image.size[1])
-
-                    self.disable_screensaver()
-                    return
-            else:
-                if self.emptyFrameCounter > 0:
-                    self.emptyFrameCounter = self.emptyFrameCounter + 1
-                    if self.firstEmptyFrameDate is not None and (time.time() - self.firstEmptyFrameDate) >= self.screensaverDelay:
-                        if not self.isScreenSaverActive:
-                            self.device.sleep()
-                            self.isScreenSaverActive = True
-                    return
-                elif self.emptyFrameCounter == 0 and self.isPILImageEmpty(newFrame):
-                    self.firstEmptyFrameDate = time.time()
-                    self.emptyFrameCounter = self.emptyFrameCounter + 1
-                    return
+        # Find the rectangle that has changed since the last frame
+        if self.previousFrame is None:
+            bbox = (0, 0, self.cols, self.rows)
+        else:
+            bbox = ImageChops.difference(newFrame, self.previousFrame).getbbox()
+
+        if bbox is None:
+            # Nothing has changed
+            self.idle()
+            return
 
         self.disable_screensaver()
 
-        self.device.move_cursor(0, 0)
-        self.device.show_pil_image(newFrame, self.cols, self.rows)
+        # The display addresses rows 8 pixels at a time so extend the rectangle to whole rows
+        x0, y0, x1, y1 = bbox
+        y0 = (y0 / 8) * 8
+        y1 = int(math.ceil(y1 / 8.0)) * 8
+
+        # If the frame is the last one moved to the left, let the display do the moving and only send the new columns
+        shift = self.findshift(newFrame)
+        if shift and shift * self.rows < (x1 - x0) * (y1 - y0):
+            self.device.scroll(shift, 0, 1, 1)
+            self.origin = (self.origin + shift) % self.memorywidth
+            self.hwscrolls += 1
+            x0, y0, x1, y1 = (self.cols - shift, 0, self.cols, self.rows)
+
+        # Only send the changed rectangle
+        self.send(newFrame, x0, y0, x1, y1)
         self.previousFrame = newFrame
 
+        # Return only once the frame is on the wire so that the caller (e.g. the display writer thread) is held back
+        # while the display is busy instead of queueing frames faster than the serial port can send them
+        self.device.drain()
+
+    def findshift(self, newFrame):
+        # Returns how many columns (up to MAXSHIFT) the previous frame has to move left to match the new frame except
+        # for the columns that move in on the right.  0 if there is no such shift or hardware scrolling is disabled
+        if not self.memorywidth or self.previousFrame is None:
+            return 0
+
+        for shift in range(1, self.MAXSHIFT + 1):
+            if newFrame.crop((0, 0, self.cols - shift, self.rows)).tobytes() == self.previousFrame.crop((shift, 0, self.cols, self.rows)).tobytes():
+                return shift
+        return 0
+
+    def send(self, image, x0, y0, x1, y1):
+        # Send the (x0, y0, x1, y1) rectangle of image to the display taking into account where the display's
+        # window is in display memory.  A rectangle that crosses the end of display memory is sent in two parts
+        if not self.memorywidth:
+            self.device.move_cursor(x0, y0)
+            self.device.show_pil_image(image.crop((x0, y0, x1, y1)), x1 - x0, y1 - y0)
+            return
+
+        x = (self.origin + x0) % self.memorywidth
+        split = min(x1, x0 + self.memorywidth - x)
+        self.device.move_cursor(x, y0)
+        self.device.show_pil_image(image.crop((x0, y0, split, y1)), split - x0, y1 - y0)
+        if split < x1:
+            self.device.move_cursor(0, y0)
+            self.device.show_pil_image(image.crop((split, y0, x1, y1)), x1 - split, y1 - y0)
+
+    def idle(self):
+        # Called when the image being displayed has not changed
+        # Puts the display to sleep once it has been blank for screensaverDelay seconds
+        if self.emptyFrameCounter > 0:
+            self.emptyFrameCounter = self.emptyFrameCounter + 1
+            if self.firstEmptyFrameDate is not None and (time.time() - self.firstEmptyFrameDate) >= self.screensaverDelay:
+                if not self.isScreenSaverActive:
+                    self.device.sleep()
+                    self.isScreenSaverActive = True
+        elif self.previousFrame is not None and self.isPILImageEmpty(self.previousFrame):
+            self.firstEmptyFrameDate = time.time()
+            self.emptyFrameCounter = self.emptyFrameCounter + 1
+
+    def cleanup(self):
+        # Send anything still queued and release the serial port
+        self.device.close()
+
     def msgtest(self, text, wait=1.5):
         self.clear()
         self.message(text)
@@ -18,6 +18,7 @@
 
 import time, math,logging
 import lcd_display_driver
+import timing
 import fonts
 from PIL import Image
 
@@ -112,6 +113,16 @@ class hd44780(lcd_display_driver.lcd_display_driver):
 		# image buffer to hold current display contents.  Used to prevent unnecessary refreshes
 		self.curimage = Image.new("1", (self.cols, self.rows))
 
+		# Shadow copy of the character codes in DDRAM (None if unknown).  Only cells whose code changes get sent to the display
+		self.ddram = [ None ] * (self.rows_char * self.cols_char)
+
+		# Custom characters currently loaded in CGRAM.  Kept across frames so that they are only uploaded when they change
+		self.cgram = lcd_display_driver.cgrammanager()
+
+		# All commands and data after initialization go through the command stream so that cursor moves the display
+		# would make on its own (DDRAM auto-increment) and repeated display control commands are not sent
+		self.stream = lcd_display_driver.commandstream(self.write4bits)
+
 		self.FONTS_SUPPORTED = True
 
 		# Initialize the default font
@@ -131,6 +142,10 @@ class hd44780(lcd_display_driver.lcd_display_driver):
 		GPIO.setup(self.pin_e, GPIO.OUT, initial=GPIO.LOW)
 		GPIO.setup(self.pin_rs, GPIO.OUT, initial=GPIO.LOW)
 
+		# Find out how long a GPIO write takes so that delays it already covers can be skipped
+		self.buslatency = timing.engine().measure(lambda: GPIO.output(self.pin_e, False))
+		self.buildnibbletable()
+
 		# there is a good writeup on the HD44780 at Wikipedia
 		# https://en.wikipedia.org/wiki/Hitachi_HD44780_LCD_controller
 
@@ -143,7 +158,7 @@ class hd44780(lcd_display_driver.lcd_display_driver):
 		displaymode = self.LCD_ENTRYLEFT | self.LCD_ENTRYSHIFTDECREMENT
 		# Write registers.
 		self.delayMicroseconds(1000)
-		self.write4bits(self.LCD_DISPLAYCONTROL | displaycontrol, False)
+		self.stream.displaycontrol(self.LCD_DISPLAYCONTROL | displaycontrol)
 		self.delayMicroseconds(2000)
 		self.write4bits(self.LCD_FUNCTIONSET | displayfunction, False)
 		self.write4bits(self.LCD_ENTRYMODESET | displaymode, False)  # set the entry mode
@@ -152,47 +167,31 @@ class hd44780(lcd_display_driver.lcd_display_driver):
 		# Set up parent class.
 		super(hd44780, self).__init__(rows,cols, self.enable_duration)
 
-	def createcustom(self, image):
-
-		if self.currentcustom == 0:
-			# initialize custom font memory
-			self.customfontlookup = {}
-
-		# The image should only be 5x8 but if larger, crop it
-		img = image.crop( (0,0,5,8) )
+	def createcustom(self, cell):
+		# Input
+		#	cell (integer) -- 5x8 image packed into a 40 bit integer (see graphics.getcells)
 
-		imgdata = list(img.convert("1").getdata())
+		# Find the slot this image is (or should be) loaded into
+		slot, upload = self.cgram.allocate(cell)
 
-		# Check to see if a custom character has already been created for this image
-		if tuple(imgdata) in self.customfontlookup:
-			return self.customfontlookup[tuple(imgdata)]
-
-		# If there is space, create a custom character using the image provided
-		if self.currentcustom > 7:
+		# If there is no space, use '?' instead
+		if slot is None:
 			return ord('?')
 
-		# Set pointer to position char in CGRAM
-		self.write4bits(self.LCD_SETCGRAMADDR+(self.currentcustom*8))
-
-		# Increment currentcustom to point to the next custom char position
-		self.currentcustom += 1
+		# Nothing to do if the slot already holds the image
+		if not upload:
+			return slot
 
+		# Set pointer to position char in CGRAM
+		# This moves the address counter out of DDRAM so the next character written will need its address set
+		self.stream.command(self.LCD_SETCGRAMADDR+(slot*8))
 
-		# For each line of data from the image
+		# For each line of data from the image send its five bit value to the custom character memory region for the current customer character
 		for j in range(8):
-			line = 0
-			# Computer a five bit value
-			for i in range(5):
-				if imgdata[j*5+i]:
-					line |= 1<<4-i
-			# And then send it to the custom character memory region for the current customer character
-			self.write4bits(line, True)
-
-		# Save custom character in lookup table
-		self.customfontlookup[tuple(imgdata)] = self.currentcustom - 1
+			self.stream.write((cell >> (7-j)*5) & 0x1F)
 
-		# Return the custom character position.  We have to subtract one as we incremented it earlier in the function
-		return self.currentcustom - 1
+		# Return the custom character position
+		return slot
 
 	def compare(self, image, position):
 		imgdata = tuple(list(image.getdata()))
@@ -210,38 +209,42 @@ class hd44780(lcd_display_driver.lcd_display_driver):
 		img = img.convert("1")
 
 
+		# Pack every 5x8 cell of the image into an integer in one pass
+		cells = graphics.getcells(img, self.cols_char, self.rows_char)
+		celllookup = self.font.celllookup
+
 		# For each character sized cell from image, try to determine what character it is
 		# by comparing it against the font reverse lookup dictionary
 		# If you find a matching entry, output the cooresponding unicode value
 		# else output a '?' symbol
-		self.currentcustom = 0
+		# Work out the pin states for the whole frame before sending any of them
+		self.stageframe()
+
+		self.cgram.newframe()
 		for j in range(self.rows_char):
 			for i in range(self.cols_char):
-				imgtest = img.crop( (i*5, j*8, (i+1)*5, (j+1)*8) )
-
-				# Check to see if the img is the same as was previously updated
-				# If it is, skip to the next character
-#				if self.compare(imgtest, (i*5, j*5)):
-#					continue
-				imgdata = tuple(list(imgtest.getdata()))
-				char = self.font.imglookup[imgdata] if imgdata in self.font.imglookup else self.createcustom(imgtest)
-				#print "Using char {0}".format(char)
-				#frame = graphics.getframe(imgtest,0,0,5,8)
-				#graphics.show(frame,5,1)
+				cell = cells[j*self.cols_char+i]
+				char = celllookup[cell] if cell in celllookup else self.createcustom(cell)
 
 				# Check to see if there is a character in the font table that matches.  If not, try to create a custom character for it.
-				char = self.character_translation[char] if self.character_translation[char] >= 0 else self.createcustom(imgtest)
+				char = self.character_translation[char] if self.character_translation[char] >= 0 else self.createcustom(cell)
+
+				# Skip the cell if the display is already showing this character
+				# A custom character that has been redefined above redraws itself wherever its code is in DDRAM
+				pos = j*self.cols_char+i
+				if self.ddram[pos] == char:
+					continue
+				self.ddram[pos] = char
 
 				# Write the resulting character value to the display
-				self.setCursor(i,j)
-				self.write4bits(char, True)
+				# The address is only sent if the previous write did not leave the display pointing at this cell
+				self.stream.setaddress(i + self.row_offsets[j])
+				self.stream.write(char)
+
+		self.sendframe()
 
 		# Save the current image to curimage
 		self.curimage.paste(image.crop((0,0,self.cols,self.rows)),(0,0))
-		self.setCursor(0,0)
-
-		displaycontrol = self.LCD_DISPLAYON | self.LCD_CURSOROFF | self.LCD_BLINKOFF
-		self.write4bits(self.LCD_DISPLAYCONTROL | displaycontrol, False)
 
 
 	def clear(self):
@@ -252,8 +255,11 @@ class hd44780(lcd_display_driver.lcd_display_driver):
 
 		self.curimage = Image.new("1",(self.cols,self.rows))
 
+		# Clearing the display fills DDRAM with spaces
+		self.ddram = [ 0x20 ] * (self.rows_char * self.cols_char)
+
 		# And then clear the screen
-		self.write4bits(self.LCD_CLEARDISPLAY) # command to clear display
+		self.stream.command(self.LCD_CLEARDISPLAY) # command to clear display
 		self.delayMicroseconds(2000) # 2000 microsecond sleep, clearing the display takes a long time
 
 	def setCursor(self, col_char, row_char):
@@ -264,7 +270,7 @@ class hd44780(lcd_display_driver.lcd_display_driver):
 		if (row_char > self.rows_char):
 			row = self.rows_char - 1 # we count rows starting w/0
 
-		self.write4bits(self.LCD_SETDDRAMADDR | (col_char + self.row_offsets[row_char]))
+		self.stream.setaddress(col_char + self.row_offsets[row_char])
 
 		self.curposition = (col_char, row_char)
 
@@ -279,8 +285,11 @@ class hd44780(lcd_display_driver.lcd_display_driver):
 			logging.debug("Can not load fontset at position {0}.  Not enough room left".format(char))
 			raise IndexError
 
+		# Custom characters loaded by update will be overwritten
+		self.cgram.reset()
+
 		# Set pointer to position char in CGRAM
-		self.write4bits(self.LCD_SETCGRAMADDR+(char*8))
+		self.stream.command(self.LCD_SETCGRAMADDR+(char*8))
 
 		# Need a short sleep for display to stablize
 		time.sleep(.01)
@@ -288,7 +297,7 @@ class hd44780(lcd_display_driver.lcd_display_driver):
 		# For each font in fontdata
 		for font in fontdata:
 			for byte in font:
-				self.write4bits(byte, True)
+				self.stream.write(byte)
 
 	def message(self, text, row_char=0, col_char=0):
 		''' Send string to LCD. Newline wraps to second line'''
@@ -296,6 +305,9 @@ class hd44780(lcd_display_driver.lcd_display_driver):
 		if row_char > self.rows_char or col_char > self.cols_char:
 			raise IndexError
 
+		# Writing directly to the display means the shadow copy of DDRAM is no longer known
+		self.ddram = [ None ] * (self.rows_char * self.cols_char)
+
 		self.setCursor(col_char, row_char)
 
 		for char in text:
@@ -309,7 +321,7 @@ class hd44780(lcd_display_driver.lcd_display_driver):
 				if c > 255: c = 32
 				ct = self.character_translation[c]
 				if ct > 0:
-					self.write4bits(self.character_translation[c], True)
+					self.stream.write(self.character_translation[c])
 
 	def cleanup(self):
 		GPIO.cleanup()
@@ -17,10 +17,13 @@
 #
 
 import time, math,logging
+import lcd_display_driver
+import timing
 import fonts
 from PIL import Image
 
 import graphics
+import i2cbatch
 try:
 	import smbus
 except:
@@ -39,6 +42,10 @@ class hd44780_i2c():
 	LCD_SETCGRAMADDR = 0x40
 	LCD_SETDDRAMADDR = 0x80
 
+	# Microseconds the controller needs to carry out a write before it can accept the next one
+	EXECUTIONTIME = 37
+	LONGEXECUTIONTIME = 1520	# Clear display and return home
+
 	# flags for display entry mode
 	LCD_ENTRYRIGHT = 0x00
 	LCD_ENTRYLEFT = 0x02
@@ -98,7 +105,7 @@ class hd44780_i2c():
 
 
 
-	def __init__(self, rows=16, cols=80, i2c_addr=0x27, i2c_bus=1, enable_duration=1):
+	def __init__(self, rows=16, cols=80, i2c_addr=0x27, i2c_bus=1, enable_duration=1, i2c_chunk=32):
 		# Default arguments are appropriate for Raspdac V3 only!!!
 
 		self.i2c_addr = i2c_addr
@@ -113,9 +120,32 @@ class hd44780_i2c():
 
 		self.bus = smbus.SMBus(i2c_bus)
 
+		# Values for the backpack's port are sent in block writes of up to i2c_chunk values (1 sends each one on its own)
+		self.transport = i2cbatch.i2cbatch(self.bus, self.i2c_addr, i2c_chunk)
+
+		# Find out how long sending a value to the backpack takes so that delays it already covers can be skipped
+		self.buslatency = timing.engine().measure(lambda: (self.transport.write(self.LCD_BACKLIGHT), self.transport.flush()))
+
+		# When batching, the values sent after each byte give the controller time to carry it out before the next
+		# enable pulse.  Work out how many idle values have to be added to make up EXECUTIONTIME on a fast bus
+		self.executionpad = 0
+		if self.transport.chunk > 1:
+			valuetime = self.transport.valuetime(self.LCD_BACKLIGHT)
+			self.executionpad = self.padding(valuetime)
+
 		# image buffer to hold current display contents.  Used to prevent unnecessary refreshes
 		self.curimage = Image.new("1", (self.cols, self.rows))
 
+		# Shadow copy of the character codes in DDRAM (None if unknown).  Only cells whose code changes get sent to the display
+		self.ddram = [ None ] * (self.rows_char * self.cols_char)
+
+		# Custom characters currently loaded in CGRAM.  Kept across frames so that they are only uploaded when they change
+		self.cgram = lcd_display_driver.cgrammanager()
+
+		# All commands and data after initialization go through the command stream so that cursor moves the display
+		# would make on its own (DDRAM auto-increment) and repeated display control commands are not sent
+		self.stream = lcd_display_driver.commandstream(self.write4bits)
+
 		self.FONTS_SUPPORTED = True
 
 		# Initialize the default font
@@ -137,7 +167,7 @@ class hd44780_i2c():
 		displaymode = self.LCD_ENTRYLEFT | self.LCD_ENTRYSHIFTDECREMENT
 		# Write registers.
 		self.delayMicroseconds(1000)
-		self.write4bits(self.LCD_DISPLAYCONTROL | displaycontrol, False)
+		self.stream.displaycontrol(self.LCD_DISPLAYCONTROL | displaycontrol)
 		self.delayMicroseconds(2000)
 		self.write4bits(self.LCD_FUNCTIONSET | displayfunction, False)
 		self.write4bits(self.LCD_ENTRYMODESET | displaymode, False)  # set the entry mode
@@ -147,71 +177,84 @@ class hd44780_i2c():
 		#super(hd44780_i2c, self).__init__(rows,cols)
 
 	def delayMicroseconds(self, microseconds):
-		seconds = microseconds / 1000000.0 # divide microseconds by 1 million for seconds
-		time.sleep(seconds)
+		# Anything still waiting to be sent has to reach the display before the delay starts
+		self.transport.flush()
+		timing.delayMicroseconds(microseconds, self.buslatency)
 
 	def write4bits(self, bits, mode=False):
 	  bits_high = mode | (bits & 0xF0) | self.LCD_BACKLIGHT
 	  bits_low = mode | ((bits<<4) & 0xF0) | self.LCD_BACKLIGHT
 
 	  # High bits
-	  self.bus.write_byte(self.i2c_addr, bits_high)
+	  self.transport.write(bits_high)
 	  self.lcd_toggle_enable(bits_high)
 
 	  # Low bits
-	  self.bus.write_byte(self.i2c_addr, bits_low)
+	  self.transport.write(bits_low)
 	  self.lcd_toggle_enable(bits_low)
 
+	  self.executiondelay(bits, mode, bits_low)
+
+	def executiontime(self, bits, mode=False):
+		# Returns how long (in microseconds) the controller needs to carry out the write of bits
+		if not mode and (bits & 0xFC) == 0:
+			return self.LONGEXECUTIONTIME
+		return self.EXECUTIONTIME
+
+	def padding(self, valuetime):
+		# Number of idle values needed after each byte for the controller to carry it out when each value takes valuetime microseconds
+		# The three values of the next nibble are sent before it is latched.  One more is added for the time measured that was not spent on the wire
+		return max(0, int(math.ceil(self.EXECUTIONTIME / max(valuetime, 1.0))) - 2)
+
+	def executiondelay(self, bits, mode, idle):
+		# Give the controller time to carry out the write of bits before anything else is latched
+		execution = self.executiontime(bits, mode)
+		if self.transport.chunk > 1 and execution <= self.EXECUTIONTIME:
+			for i in range(self.executionpad):
+				self.transport.write(idle)
+		else:
+			self.delayMicroseconds(execution)
+
 
 	def lcd_toggle_enable(self, bits):
+		# When values are being batched the time it takes to send each one covers the enable timing
+		if self.transport.chunk > 1:
+			self.transport.write(bits | self.ENABLE)
+			self.transport.write(bits & ~self.ENABLE)
+			return
+
 		# Toggle enable
 		self.delayMicroseconds(self.enable_duration)
-		self.bus.write_byte(self.i2c_addr, (bits | self.ENABLE))
+		self.transport.write(bits | self.ENABLE)
 		self.delayMicroseconds(self.enable_duration)
-		self.bus.write_byte(self.i2c_addr,(bits & ~self.ENABLE))
+		self.transport.write(bits & ~self.ENABLE)
 		self.delayMicroseconds(self.enable_duration)
 
-	def createcustom(self, image):
-
-		if self.currentcustom == 0:
-			# initialize custom font memory
-			self.customfontlookup = {}
+	def createcustom(self, cell):
+		# Input
+		#	cell (integer) -- 5x8 image packed into a 40 bit integer (see graphics.getcells)
 
-		# The image should only be 5x8 but if larger, crop it
-		img = image.crop( (0,0,5,8) )
+		# Find the slot this image is (or should be) loaded into
+		slot, upload = self.cgram.allocate(cell)
 
-		imgdata = list(img.convert("1").getdata())
-
-		# Check to see if a custom character has already been created for this image
-		if tuple(imgdata) in self.customfontlookup:
-			return self.customfontlookup[tuple(imgdata)]
-
-		# If there is space, create a custom character using the image provided
-		if self.currentcustom > 7:
+		# If there is no space, use '?' instead
+		if slot is None:
 			return ord('?')
 
-		# Set pointer to position char in CGRAM
-		self.write4bits(self.LCD_SETCGRAMADDR+(self.currentcustom*8))
-
-		# Increment currentcustom to point to the next custom char position
-		self.currentcustom += 1
+		# Nothing to do if the slot already holds the image
+		if not upload:
+			return slot
 
+		# Set pointer to position char in CGRAM
+		# This moves the address counter out of DDRAM so the next character written will need its address set
+		self.stream.command(self.LCD_SETCGRAMADDR+(slot*8))
 
-		# For each line of data from the image
+		# For each line of data from the image send its five bit value to the custom character memory region for the current customer character
 		for j in range(8):
-			line = 0
-			# Computer a five bit value
-			for i in range(5):
-				if imgdata[j*5+i]:
-					line |= 1<<4-i
-			# And then send it to the custom character memory region for the current customer character
-			self.write4bits(line, True)
-
-		# Save custom character in lookup table
-		self.customfontlookup[tuple(imgdata)] = self.currentcustom - 1
+			self.stream.write((cell >> (7-j)*5) & 0x1F)
 
-		# Return the custom character position.  We have to subtract one as we incremented it earlier in the function
-		return self.currentcustom - 1
+		# Return the custom character position
+		return slot
 
 	def compare(self, image, position):
 		imgdata = tuple(list(image.getdata()))
@@ -229,38 +272,40 @@ class hd44780_i2c():
 		img = img.convert("1")
 
 
+		# Pack every 5x8 cell of the image into an integer in one pass
+		cells = graphics.getcells(img, self.cols_char, self.rows_char)
+		celllookup = self.font.celllookup
+
 		# For each character sized cell from image, try to determine what character it is
 		# by comparing it against the font reverse lookup dictionary
 		# If you find a matching entry, output the cooresponding unicode value
 		# else output a '?' symbol
-		self.currentcustom = 0
+		self.cgram.newframe()
 		for j in range(self.rows_char):
 			for i in range(self.cols_char):
-				imgtest = img.crop( (i*5, j*8, (i+1)*5, (j+1)*8) )
-
-				# Check to see if the img is the same as was previously updated
-				# If it is, skip to the next character
-#				if self.compare(imgtest, (i*5, j*5)):
-#					continue
-				imgdata = tuple(list(imgtest.getdata()))
-				char = self.font.imglookup[imgdata] if imgdata in self.font.imglookup else self.createcustom(imgtest)
-				#print "Using char {0}".format(char)
-				#frame = graphics.getframe(imgtest,0,0,5,8)
-				#graphics.show(frame,5,1)
+				cell = cells[j*self.cols_char+i]
+				char = celllookup[cell] if cell in celllookup else self.createcustom(cell)
 
 				# Check to see if there is a character in the font table that matches.  If not, try to create a custom character for it.
-				char = self.character_translation[char] if self.character_translation[char] >= 0 else self.createcustom(imgtest)
+				char = self.character_translation[char] if self.character_translation[char] >= 0 else self.createcustom(cell)
+
+				# Skip the cell if the display is already showing this character
+				# A custom character that has been redefined above redraws itself wherever its code is in DDRAM
+				pos = j*self.cols_char+i
+				if self.ddram[pos] == char:
+					continue
+				self.ddram[pos] = char
 
 				# Write the resulting character value to the display
-				self.setCursor(i,j)
-				self.write4bits(char, True)
+				# The address is only sent if the previous write did not leave the display pointing at this cell
+				self.stream.setaddress(i + self.row_offsets[j])
+				self.stream.write(char)
 
 		# Save the current image to curimage
 		self.curimage.paste(image.crop((0,0,self.cols,self.rows)),(0,0))
-		self.setCursor(0,0)
 
-		displaycontrol = self.LCD_DISPLAYON | self.LCD_CURSOROFF | self.LCD_BLINKOFF
-		self.write4bits(self.LCD_DISPLAYCONTROL | displaycontrol, False)
+		# Send whatever is left of the frame
+		self.transport.flush()
 
 
 	def clear(self):
@@ -271,8 +316,11 @@ class hd44780_i2c():
 
 		self.curimage = Image.new("1",(self.cols,self.rows))
 
+		# Clearing the display fills DDRAM with spaces
+		self.ddram = [ 0x20 ] * (self.rows_char * self.cols_char)
+
 		# And then clear the screen
-		self.write4bits(self.LCD_CLEARDISPLAY) # command to clear display
+		self.stream.command(self.LCD_CLEARDISPLAY) # command to clear display
 		self.delayMicroseconds(2000) # 2000 microsecond sleep, clearing the display takes a long time
 
 	def setCursor(self, col_char, row_char):
@@ -283,7 +331,7 @@ class hd44780_i2c():
 		if (row_char > self.rows_char):
 			row = self.rows_char - 1 # we count rows starting w/0
 
-		self.write4bits(self.LCD_SETDDRAMADDR | (col_char + self.row_offsets[row_char]))
+		self.stream.setaddress(col_char + self.row_offsets[row_char])
 
 		self.curposition = (col_char, row_char)
 
@@ -298,16 +346,20 @@ class hd44780_i2c():
 			logging.debug("Can not load fontset at position {0}.  Not enough room left".format(char))
 			raise IndexError
 
+		# Custom characters loaded by update will be overwritten
+		self.cgram.reset()
+
 		# Set pointer to position char in CGRAM
-		self.write4bits(self.LCD_SETCGRAMADDR+(char*8))
+		self.stream.command(self.LCD_SETCGRAMADDR+(char*8))
 
 		# Need a short sleep for display to stablize
-		time.sleep(.01)
+		self.delayMicroseconds(10000)
 
 		# For each font in fontdata
 		for font in fontdata:
 			for byte in font:
-				self.write4bits(byte, True)
+				self.stream.write(byte)
+		self.transport.flush()
 
 	def message(self, text, row_char=0, col_char=0):
 		''' Send string to LCD. Newline wraps to second line'''
@@ -315,6 +367,9 @@ class hd44780_i2c():
 		if row_char > self.rows_char or col_char > self.cols_char:
 			raise IndexError
 
+		# Writing directly to the display means the shadow copy of DDRAM is no longer known
+		self.ddram = [ None ] * (self.rows_char * self.cols_char)
+
 		self.setCursor(col_char, row_char)
 
 		for char in text:
@@ -328,7 +383,8 @@ class hd44780_i2c():
 				if c > 255: c = 32
 				ct = self.character_translation[c]
 				if ct > 0:
-					self.write4bits(self.character_translation[c], True)
+					self.stream.write(self.character_translation[c])
+		self.transport.flush()
 
 
 	def msgtest(self, text, wait=1.5):
@@ -0,0 +1,149 @@
+#!/usr/bin/python
+# coding: UTF-8
+
+# Batched I2C transport for port expander based display backpacks (PCF8574, MCP23008)
+#
+# Driving an HD44780 through a port expander takes six bus writes per byte sent to the
+# display (a data/enable/end-enable triple for each nibble).  Sending each of these as
+# its own SMBus transaction makes the per transaction overhead the limit on how fast the
+# display can be refreshed.  i2cbatch collects the port values and sends them as SMBus
+# block writes instead.
+#
+# PCF8574:  The expander has no registers.  Every byte that follows the address is
+#           written to the port so the values can simply be streamed.
+# MCP23008: Values are written to the GPIO register.  The expander must have sequential
+#           operation disabled (IOCON.SEQOP) so that each byte of a block write goes to
+#           the same register.
+#
+# Each byte of a block write takes ~90us at 100kHz which is far longer than the enable
+# pulse (450ns) and the time the HD44780 needs to execute a command (37us) so no delays
+# are needed between values in a batch.  Commands that take longer (e.g. clear) must
+# flush the batch before waiting.  On faster buses the values between two writes may not
+# cover the 37us so the drivers pad the batch with idle values (see valuetime).
+
+import logging
+import timing
+
+class i2cbatch(object):
+
+	MAXBLOCK = 32 # SMBus limits block writes to 32 data bytes
+
+	def __init__(self, bus, i2c_addr, chunk=32, register=None):
+		# Input
+		#	bus (SMBus) -- Bus the expander is on
+		#	i2c_addr (integer) -- Address of the expander
+		#	chunk (integer) -- Number of port values to send per transaction.  1 sends each value as soon as it is written
+		#	register (integer) -- Register to write the values to (None for expanders without registers such as the PCF8574)
+
+		self.bus = bus
+		self.i2c_addr = i2c_addr
+		self.register = register
+
+		# Without a register the command byte of the block write is also a port value
+		maxchunk = self.MAXBLOCK if register is not None else self.MAXBLOCK+1
+		self.chunk = max(1, min(int(chunk), maxchunk))
+		if self.chunk != chunk:
+			logging.debug(u'I2C chunk size {0} out of range.  Using {1}'.format(chunk, self.chunk))
+
+		self.pending = [ ]
+
+		# Statistics
+		self.transactions = 0	# Bus transactions made
+		self.values = 0			# Port values sent
+
+	def write(self, value):
+		# Queue a value for the port, sending the queue when it reaches the chunk size
+		self.pending.append(value & 0xFF)
+		if len(self.pending) >= self.chunk:
+			self.flush()
+
+	def flush(self):
+		# Send everything that has been queued
+		pending = self.pending
+		self.pending = [ ]
+
+		for i in range(0, len(pending), self.chunk):
+			block = pending[i:i+self.chunk]
+			if self.register is not None:
+				if len(block) == 1:
+					self.bus.write_byte_data(self.i2c_addr, self.register, block[0])
+				else:
+					self.bus.write_i2c_block_data(self.i2c_addr, self.register, block)
+			else:
+				if len(block) == 1:
+					self.bus.write_byte(self.i2c_addr, block[0])
+				else:
+					self.bus.write_i2c_block_data(self.i2c_addr, block[0], block[1:])
+			self.transactions += 1
+			self.values += len(block)
+
+	def valuetime(self, value, samples=5):
+		# Returns how long (in microseconds) each value of a full chunk takes to send
+		# value is sent samples*chunk times so it must leave the port in a safe state (e.g. enable low)
+		def send():
+			self.pending.extend([ value & 0xFF ] * self.chunk)
+			self.flush()
+
+		self.flush()
+		return timing.engine().measure(send, samples) / self.chunk
+
+	def stats(self):
+		return { 'transactions': self.transactions, 'values': self.values }
+
+
+class fakesmbus(object):
+	# Stand in for smbus.SMBus that records what would have been sent instead of talking to a device
+	# Use it to test or benchmark drivers on a machine without an I2C bus
+	#
+	# transactions holds (addr, bytes) for every transaction where bytes are the bytes following the address
+
+	def __init__(self, bus=1):
+		self.transactions = [ ]
+
+	def write_byte(self, addr, value):
+		self.transactions.append( (addr, [ value ]) )
+
+	def write_byte_data(self, addr, register, value):
+		self.transactions.append( (addr, [ register, value ]) )
+
+	def write_i2c_block_data(self, addr, register, values):
+		if len(values) > i2cbatch.MAXBLOCK:
+			raise IOError(u'Block write of {0} bytes is larger than {1}'.format(len(values), i2cbatch.MAXBLOCK))
+		self.transactions.append( (addr, [ register ] + list(values)) )
+
+	def portvalues(self, register=None):
+		# Returns every value written to the port (or register) in order
+		values = [ ]
+		for addr, data in self.transactions:
+			if register is None:
+				values += data
+			elif data[0] == register:
+				values += data[1:]
+		return values
+
+	def bytessent(self):
+		# Bytes on the wire including the address byte of each transaction
+		return sum([ len(data)+1 for addr, data in self.transactions ])
+
+
+if __name__ == '__main__':
+
+	import sys, time
+
+	# Compare the number of transactions needed to send a full 20x4 display at different chunk sizes
+	values = [ ]
+	for c in range(80):
+		for nibble in (0x40, 0x10):
+			values += [ nibble | 0x09, nibble | 0x0D, nibble | 0x09 ]
+
+	for chunk in [ 1, 4, 8, 16, 32, 33 ]:
+		bus = fakesmbus()
+		transport = i2cbatch(bus, 0x27, chunk)
+		start = time.time()
+		for v in values:
+			transport.write(v)
+		transport.flush()
+		if bus.portvalues() != values:
+			print u'chunk {0}: values sent do not match'.format(chunk)
+			sys.exit(1)
+		print u'chunk {0:>2}: {1:>4} transactions, {2:>4} bytes on the wire, {3:.2f}ms'.format(chunk, transport.transactions, bus.bytessent(), (time.time()-start)*1000)
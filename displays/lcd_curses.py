@@ -91,12 +91,12 @@ class lcd_curses(lcd_display_driver.lcd_display_driver):
 		rows = int(math.ceil(self.rows/8.0))
 		for j in range(0, rows):
 #			self.setCursor(j*8,0)
-			for i in range(0, self.cols):
+
+			# Draw the line as is, padding it with blank columns if it is short
+			line = bytearray(newbuf[j][:self.cols]) if j < len(newbuf) else bytearray()
+			line.extend(bytearray(self.cols-len(line)))
+			for i, byte in enumerate(line):
 				self.setCursor(j*8,i)
-				try:
-					byte = newbuf[j][i]
-				except IndexError:
-					byte = 0
 				self.write4bits(byte, True)
 
 		self.stdscr.refresh()
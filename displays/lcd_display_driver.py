@@ -2,6 +2,8 @@
 
 import abc, fonts, time
 import math
+import graphics
+import timing
 from PIL import Image
 
 try:
@@ -11,6 +13,116 @@ except:
 	print "GPIO not installed"
 	GPIO_INSTALLED=False
 
+class cgrammanager(object): # Keeps track of the custom characters loaded into the CGRAM of an HD44780 style display
+	def __init__(self, slots=8):
+		# Input
+		#	slots (integer) -- Number of custom characters the display can hold
+
+		self.patterns = [ None ] * slots	# The pattern loaded into each slot (None if unknown)
+		self.lookup = { }					# Pattern -> slot it is loaded in
+		self.lastused = [ 0 ] * slots		# The frame each slot was last used in
+		self.frame = 0
+
+		# Statistics
+		self.hits = 0		# Requests for a pattern that was already loaded
+		self.uploads = 0	# Patterns that had to be written to CGRAM
+		self.evictions = 0	# Uploads that replaced a pattern that was loaded
+		self.overflows = 0	# Requests that could not be met because every slot was in use for the current frame
+
+	def newframe(self): # Call at the start of each frame.  Slots used during the frame will not be evicted until the next one
+		self.frame += 1
+
+	def allocate(self, pattern):
+		# Returns the slot to use for pattern and whether the pattern needs to be uploaded into it
+		# or (None, False) if every slot is already in use for this frame
+
+		slot = self.lookup.get(pattern)
+		if slot is not None:
+			self.lastused[slot] = self.frame
+			self.hits += 1
+			return (slot, False)
+
+		# Use an empty slot if there is one, otherwise the least recently used slot that is not needed for this frame
+		candidates = [ i for i in range(len(self.patterns)) if self.lastused[i] != self.frame or self.patterns[i] is None ]
+		if not candidates:
+			self.overflows += 1
+			return (None, False)
+		slot = min(candidates, key=lambda i: (self.patterns[i] is not None, self.lastused[i]))
+
+		if self.patterns[slot] is not None:
+			del self.lookup[self.patterns[slot]]
+			self.evictions += 1
+		self.patterns[slot] = pattern
+		self.lookup[pattern] = slot
+		self.lastused[slot] = self.frame
+		self.uploads += 1
+		return (slot, True)
+
+	def reset(self): # Forget what is loaded (e.g. after CGRAM has been written directly)
+		self.patterns = [ None ] * len(self.patterns)
+		self.lookup = { }
+
+	def stats(self):
+		return { 'hits': self.hits, 'uploads': self.uploads, 'evictions': self.evictions, 'overflows': self.overflows, 'frames': self.frame }
+
+class commandstream(object): # Sits between an HD44780 style driver and write4bits and drops commands that would not change the display
+	def __init__(self, write4bits):
+		# Input
+		#	write4bits (function) -- The driver's write4bits(bits, mode) function
+
+		self.write4bits = write4bits
+		self.address = None	# The DDRAM address the next data write will go to (None if unknown or pointing into CGRAM)
+		self.control = None	# Last display control command sent
+
+		# Statistics
+		self.commands = 0	# Commands sent
+		self.data = 0		# Data bytes sent
+		self.skipped = 0	# Commands dropped because they were not needed
+
+	def nextaddress(self, address):
+		# DDRAM address that follows address after a write.  In two line mode the first line runs from 0x00 to 0x27
+		# and the second from 0x40 to 0x67 with each wrapping to the start of the other
+		if address == 0x27:
+			return 0x40
+		if address == 0x67:
+			return 0x00
+		return address + 1
+
+	def command(self, bits):
+		# Send a command.  Anything other than setting the DDRAM address leaves the address unknown
+		self.write4bits(bits, False)
+		self.commands += 1
+		self.address = bits & 0x7F if bits & 0x80 else None
+
+	def setaddress(self, address):
+		# Move to a DDRAM address unless the address counter is already there (e.g. from the previous write)
+		if self.address == address:
+			self.skipped += 1
+			return
+		self.command(0x80 | address)
+
+	def write(self, bits):
+		# Write a data byte to DDRAM or CGRAM (whichever the last address command pointed to)
+		self.write4bits(bits, True)
+		self.data += 1
+		if self.address is not None:
+			self.address = self.nextaddress(self.address)
+
+	def displaycontrol(self, bits):
+		# Send a display control command only if it differs from the last one sent
+		if self.control == bits:
+			self.skipped += 1
+			return
+		self.control = bits
+		self.command(bits)
+
+	def reset(self): # Forget the display's state (e.g. after it has been reinitialized)
+		self.address = None
+		self.control = None
+
+	def stats(self):
+		return { 'commands': self.commands, 'data': self.data, 'skipped': self.skipped }
+
 class lcd_display_driver:
 	__metaclass__ = abc.ABCMeta
 
@@ -19,6 +131,18 @@ class lcd_display_driver:
 
 	FONTS_SUPPORTED = True
 
+	# Microseconds a GPIO write takes.  Delays that are no longer than this are skipped
+	buslatency = 0
+
+	# Microseconds the controller needs to carry out a write before it can accept the next one.  These are never skipped
+	EXECUTIONTIME = 37
+	LONGEXECUTIONTIME = 1520	# Clear display and return home
+
+	nibblepins = None	# RS followed by the data pins (D7 to D4)
+	nibbletable = None	# Values for nibblepins for every nibble.  0-15 with RS low (command), 16-31 with RS high (data)
+	pinstate = None		# Values currently on nibblepins (None if unknown)
+	staged = None		# (pin states, execution time) waiting to be sent while a frame is being staged (None when writing straight to the pins)
+
 	def __init__(self, rows, columns, enable_duration):
 		self.rows = rows
 		self.columns = columns
@@ -32,22 +156,23 @@ class lcd_display_driver:
 #			self.FONTS_SUPPORTED = False
 #			pass
 
+	def buildnibbletable(self):
+		# Work out the values RS and the data pins need for every nibble once instead of on every write
+		self.nibblepins = [ self.pin_rs ] + self.pins_db[::-1]
+		self.nibbletable = [ (rs, (n>>3)&1, (n>>2)&1, (n>>1)&1, n&1) for rs in (0, 1) for n in range(16) ]
+		self.pinstate = None
+
+	def executiontime(self, bits, char_mode=False):
+		# Returns how long (in microseconds) the controller needs to carry out the write of bits
+		if not char_mode and (bits & 0xFC) == 0:
+			return self.LONGEXECUTIONTIME
+		return self.EXECUTIONTIME
+
 	def write4bits(self, bits, char_mode=False):
 
 		if GPIO_INSTALLED:
-#			self.delayMicroseconds(1000)
-			GPIO.output(self.pin_rs, char_mode)
-			GPIO.output(self.pins_db[::-1][0], bits & 0x80)
-			GPIO.output(self.pins_db[::-1][1], bits & 0x40)
-			GPIO.output(self.pins_db[::-1][2], bits & 0x20)
-			GPIO.output(self.pins_db[::-1][3], bits & 0x10)
-			self.pulseEnable()
-
-			GPIO.output(self.pins_db[::-1][0], bits & 0x08)
-			GPIO.output(self.pins_db[::-1][1], bits & 0x04)
-			GPIO.output(self.pins_db[::-1][2], bits & 0x02)
-			GPIO.output(self.pins_db[::-1][3], bits & 0x01)
-			self.pulseEnable()
+			self.writenibble((bits>>4) & 0x0F, char_mode)
+			self.writenibble(bits & 0x0F, char_mode, self.executiontime(bits, char_mode))
 
 
 	def writeonly4bits(self, bits, char_mode=False):
@@ -56,17 +181,65 @@ class lcd_display_driver:
 		if bits > 15: return
 
 		if GPIO_INSTALLED:
-			GPIO.output(self.pin_rs, char_mode)
-			GPIO.output(self.pins_db[::-1][0], bits & 0x08)
-			GPIO.output(self.pins_db[::-1][1], bits & 0x04)
-			GPIO.output(self.pins_db[::-1][2], bits & 0x02)
-			GPIO.output(self.pins_db[::-1][3], bits & 0x01)
-			self.pulseEnable()
+			self.writenibble(bits, char_mode, self.EXECUTIONTIME)
+
+
+	def writenibble(self, nibble, char_mode=False, execution=0):
+		# Set RS and all of the data pins with a single GPIO call and then latch them with the enable pin
+		# execution is how long (in microseconds) to wait afterwards for the controller to carry out the write
+
+		if self.nibbletable is None:
+			self.buildnibbletable()
+		values = self.nibbletable[nibble + (16 if char_mode else 0)]
+
+		if self.staged is not None:
+			self.staged.append( (values, execution) )
+			return
+
+		# The pins hold their values so they only need to be written when they change
+		if values != self.pinstate:
+			GPIO.output(self.nibblepins, values)
+			self.pinstate = values
+		self.pulseEnable()
+
+		# Not covered by the GPIO writes as the next enable pulse can follow straight away
+		if execution:
+			timing.delayMicroseconds(execution)
+
+
+	def stageframe(self):
+		# Collect the pin states for everything written until sendframe is called instead of sending them right away
+		if self.staged is None:
+			self.staged = [ ]
+
+	def sendframe(self):
+		# Send the pin states collected since stageframe was called and go back to writing straight to the pins
+		staged = self.staged
+		self.staged = None
+		if not staged:
+			return
+
+		output = GPIO.output
+		pins = self.nibblepins
+		pulse = self.pulseEnable
+		delay = timing.delayMicroseconds
+		current = self.pinstate
+		for values, execution in staged:
+			if values != current:
+				output(pins, values)
+				current = values
+			pulse()
+			if execution:
+				delay(execution)
+		self.pinstate = current
 
 
 	def delayMicroseconds(self, microseconds):
-		seconds = microseconds / 1000000.0 # divide microseconds by 1 million for seconds
-		time.sleep(seconds)
+		# Anything that has been staged has to reach the display before the delay starts
+		if self.staged:
+			self.sendframe()
+			self.stageframe()
+		timing.delayMicroseconds(microseconds, self.buslatency)
 
 
 	def pulseEnable(self):
@@ -82,47 +255,14 @@ class lcd_display_driver:
 
 
 	def getframe(self,image,x,y,width,height):
-		# Returns an array of arrays
+		# Returns an array of bytearrays, one for each 8 pixel high line of the image
 		# [
-		#   [ ], # Array of bytes for line 0
-		#   [ ]  # Array of bytes for line 1
+		#   bytearray, # bytes for line 0
+		#   bytearray  # bytes for line 1
 		#				 ...
-		#   [ ]  # Array of bytes for line n
+		#   bytearray  # bytes for line n
 		# ]
-
-		# Select portion of image to work with
-		img = image.convert("1")
-
-		width, height = img.size
-		bheight = int(math.ceil(height / 8.0))
-		imgdata = list(img.getdata())
-
-
-		retval = []	# The variable to hold the return value (an array of byte arrays)
-		retline = [0]*width # Line to hold the first byte of image data
-		bh = 0 # Used to determine when we've consumed a byte worth of the line
-
-		# Perform a horizontal iteration of the image data
-		for i in range(0,height):
-			for j in range(0,width):
-				# if the value is true then mask a bit into the byte within retline
-				if imgdata[(i*width)+j]:
-					try:
-						retline[j] |= 1<<bh
-					except IndexError as e:
-						# WTF
-						print "width = {0}".format(width)
-						raise e
-			# If we've written a full byte, start a new retline
-			bh += 1
-			if bh == 8: # We reached a byte boundary
-				bh = 0
-				retval.append(retline)
-				retline = [0]*width
-		if bh > 0:
-			retval.append(retline)
-
-		return retval
+		return graphics.getframe(image,x,y,width,height)
 
 	def switchcustomchars(self, fontpkg):
 		if self.FONTS_SUPPORTED:
@@ -0,0 +1,135 @@
+#!/usr/bin/python
+# coding: UTF-8
+
+# Microsecond delays for bit-banged display drivers
+#
+# time.sleep can not be used for the short delays the display controllers need (e.g. a
+# 450ns enable pulse) as the scheduler will not wake the process up again for tens to
+# hundreds of microseconds.  With thousands of pulses per frame that becomes most of the
+# time it takes to update the display.
+#
+# delayengine busy-waits on the clock for short delays and only sleeps for long ones.  A
+# delay can also be skipped when the bus write that came before it is known to take at
+# least as long (e.g. a GPIO write or an I2C transaction).
+#
+# The engine calibrates itself the first time it is used by measuring how long it takes to
+# read the clock and by how much a sleep overruns what was asked for.
+
+import time, logging
+
+class delayengine(object):
+
+	def __init__(self, sleepthreshold=1000, timer=time.time):
+		# Input
+		#	sleepthreshold (float) -- Delays at least this long (in microseconds) sleep for most of the time instead of busy-waiting
+		#	timer (function) -- Clock to use.  Must return seconds
+
+		self.sleepthreshold = sleepthreshold
+		self.timer = timer
+
+		self.overhead = 0.0			# Microseconds it takes to make a busy-wait delay (time spent before the clock is first checked)
+		self.sleepoverrun = 0.0		# Microseconds a sleep lasts longer than requested
+		self.calibrated = False
+
+		# Statistics
+		self.spins = 0		# Delays done by busy-waiting
+		self.sleeps = 0		# Delays done by sleeping
+		self.skipped = 0	# Delays skipped because they were already covered
+
+	def calibrate(self, samples=1000):
+		# Measure the cost of checking the clock and how much a sleep overruns
+		timer = self.timer
+
+		start = timer()
+		for i in range(samples):
+			self.spin(0)
+		self.overhead = (timer() - start) * 1000000.0 / samples
+
+		# Sleep for the shortest time a delay would sleep for
+		overrun = [ ]
+		for i in range(10):
+			start = timer()
+			time.sleep(self.sleepthreshold / 1000000.0)
+			overrun.append((timer() - start) * 1000000.0 - self.sleepthreshold)
+		self.sleepoverrun = max(0.0, sorted(overrun)[len(overrun)/2])
+
+		self.calibrated = True
+		logging.info(u'Delay calibration: {0:.2f}us overhead per delay, {1:.0f}us sleep overrun'.format(self.overhead, self.sleepoverrun))
+		return self
+
+	def measure(self, write, samples=20):
+		# Returns the average time (in microseconds) that write takes.  Use it to find out which delays a bus write already covers
+		start = self.timer()
+		for i in range(samples):
+			write()
+		latency = (self.timer() - start) * 1000000.0 / samples
+		logging.info(u'Bus write takes {0:.2f}us'.format(latency))
+		return latency
+
+	def spin(self, microseconds):
+		end = self.timer() + microseconds / 1000000.0
+		while self.timer() < end:
+			pass
+
+	def delay(self, microseconds, covered=0):
+		# Input
+		#	microseconds (float) -- Time to wait
+		#	covered (float) -- Time (in microseconds) that has already passed because of the write that came before the delay
+
+		if not self.calibrated:
+			self.calibrate()
+
+		if microseconds <= covered:
+			self.skipped += 1
+			return
+
+		if microseconds < self.sleepthreshold:
+			self.spins += 1
+			if microseconds > self.overhead:
+				self.spin(microseconds - self.overhead)
+			return
+
+		# Sleep for as much of the delay as possible and then spin for whatever is left
+		self.sleeps += 1
+		end = self.timer() + microseconds / 1000000.0
+		sleep = microseconds - self.sleepoverrun
+		if sleep > 0:
+			time.sleep(sleep / 1000000.0)
+		while self.timer() < end:
+			pass
+
+	def stats(self):
+		return { 'spins': self.spins, 'sleeps': self.sleeps, 'skipped': self.skipped, 'overhead': self.overhead, 'sleepoverrun': self.sleepoverrun }
+
+# Engine shared by all of the drivers
+shared = None
+
+def engine():
+	global shared
+	if shared is None:
+		shared = delayengine().calibrate()
+	return shared
+
+def delayMicroseconds(microseconds, covered=0):
+	engine().delay(microseconds, covered)
+
+
+if __name__ == '__main__':
+
+	e = engine()
+	print u'Overhead per delay {0:.2f}us, sleep overrun {1:.0f}us'.format(e.overhead, e.sleepoverrun)
+
+	for us in [ 0.1, 1, 10, 100, 1000, 2000, 10000 ]:
+		n = 100 if us < 1000 else 10
+
+		start = time.time()
+		for i in range(n):
+			delayMicroseconds(us)
+		actual = (time.time() - start) * 1000000.0 / n
+
+		start = time.time()
+		for i in range(n):
+			time.sleep(us / 1000000.0)
+		slept = (time.time() - start) * 1000000.0 / n
+
+		print u'{0:>8}us: delay {1:>9.1f}us  time.sleep {2:>9.1f}us'.format(us, actual, slept)
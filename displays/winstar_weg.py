@@ -24,6 +24,7 @@ from __future__ import unicode_literals
 
 import time, math,logging
 import lcd_display_driver
+import timing
 import fonts
 import graphics as g
 from PIL import Image
@@ -109,6 +110,10 @@ class winstar_weg(lcd_display_driver.lcd_display_driver):
 
 		GPIO.setup(self.pin_e, GPIO.OUT, initial=GPIO.LOW)
 		GPIO.setup(self.pin_rs, GPIO.OUT, initial=GPIO.LOW)
+
+		# Find out how long a GPIO write takes so that delays it already covers can be skipped
+		self.buslatency = timing.engine().measure(lambda: GPIO.output(self.pin_e, False))
+		self.buildnibbletable()
 		GPIO.output(self.pin_e, False)
 
 		# initialization sequence taken from audiophonics.fr site
@@ -196,16 +201,21 @@ class winstar_weg(lcd_display_driver.lcd_display_driver):
 
 	def updateframe(self, newbuf):
 
+		# Work out the pin states for the whole frame before sending any of them
+		self.stageframe()
+
 		rows = int(math.ceil(self.rows/8.0))
 		for j in range(0, rows):
 			self.setCursor(j*8,0)
-			for i in range(0, self.cols):
-				try:
-					byte = newbuf[j][i]
-				except IndexError:
-					byte = 0
+
+			# Send the line as is, padding it with blank columns if it is short
+			line = bytearray(newbuf[j][:self.cols]) if j < len(newbuf) else bytearray()
+			line.extend(bytearray(self.cols-len(line)))
+			for byte in line:
 				self.write4bits(byte, True)
 
+		self.sendframe()
+
 	def cleanup(self):
 		GPIO.cleanup()
 
@@ -5,7 +5,7 @@
 # Written by: Ron Ritchey
 
 from __future__ import unicode_literals
-import json, threading, logging, Queue, time, sys, getopt, moment, signal, commands, os, copy, datetime, math, requests
+import json, threading, logging, Queue, time, sys, getopt, moment, signal, commands, os, copy, datetime, math, requests, select, fcntl
 import pages
 import displays
 import sources
@@ -20,6 +20,53 @@ import pause
 
 exitapp = [ False ]
 
+# Longest time in seconds the display loop will sleep without being woken
+# The music controller updates the time variables and wakes the loop every second anyway so a longer cap would
+# not make the loop sleep any longer.  It is a safety net in case a wake is missed
+MAX_IDLE = 1
+
+class notifyqueue(Queue.Queue):
+    # Queue that can be waited on with select
+    # On Python 2 Queue.get with a timeout polls (sleeping up to 50ms at a time) which keeps waking an idle system
+
+    def __init__(self, maxsize=0):
+        Queue.Queue.__init__(self, maxsize)
+
+        # A byte is written to the pipe for every item put on the queue
+        self.pipe = os.pipe()
+        for fd in self.pipe:
+            fcntl.fcntl(fd, fcntl.F_SETFL, fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+
+    def _put(self, item):
+        Queue.Queue._put(self, item)
+        try:
+            os.write(self.pipe[1], b'.')
+        except OSError:
+            # Pipe is full so the waiting thread will already wake up
+            pass
+
+    def wait(self, timeout):
+        # Wait up to timeout seconds for an item to be put on the queue.  Returns True if there may be one to get
+        if not self.empty():
+            return True
+
+        try:
+            r, w, x = select.select([ self.pipe[0] ], [], [], max(timeout, 0))
+        except select.error:
+            # Interrupted (e.g. by a signal)
+            return False
+
+        if not r:
+            return False
+
+        try:
+            while os.read(self.pipe[0], 4096):
+                pass
+        except OSError:
+            # Pipe is empty
+            pass
+        return True
+
 class music_controller(threading.Thread):
     # Receives updates from music services
     # Determines what page to displays
@@ -82,7 +129,7 @@ class music_controller(threading.Thread):
         threading.Thread.__init__(self)
 
         self.daemon = True
-        self.musicqueue = Queue.Queue()
+        self.musicqueue = notifyqueue()
         self.image = None
         self.showupdates = showupdates
         self.display_controller = display_controller
@@ -170,14 +217,16 @@ class music_controller(threading.Thread):
                 time.sleep(pydPiper_config.STARTUP_MSG_DURATION)
                 with self.musicdata_lock:
                     self.musicdata['state'] = 'stop'
+                self.display_controller.wake()
                 continue
 
-            # Attempt to get an update from the queue
-            try:
-                updates = self.musicqueue.get_nowait()
-                self.musicqueue.task_done()
-            except Queue.Empty:
-                pass
+            # Wait for an update from the queue.  If none arrives, wake up at the next clock tick to update the time variables
+            if self.musicqueue.wait(max(math.floor(time.time())+1-time.time(), 0.01)):
+                try:
+                    updates = self.musicqueue.get_nowait()
+                    self.musicqueue.task_done()
+                except Queue.Empty:
+                    pass
 
             # Get current time
             try:
@@ -259,13 +308,18 @@ class music_controller(threading.Thread):
                 # Set lastupdate time to 1 second in the future
                 lastupdate = time.time()+1
 
-                self.musicdata[u'time_formatted'] = moment.utcnow().timezone(pydPiper_config.TIMEZONE).strftime('%H:%M').strip().decode()
-                # To support previous key used for this purpose
-                self.musicdata[u'current_time_formatted'] = self.musicdata[u'time_formatted']
+                # next changes the display controller's state (frame, generation, canvases) so it must not run at the same time as the display loop
+                with self.musicdata_lock:
+                    self.musicdata[u'time_formatted'] = moment.utcnow().timezone(pydPiper_config.TIMEZONE).strftime('%H:%M').strip().decode()
+                    # To support previous key used for this purpose
+                    self.musicdata[u'current_time_formatted'] = self.musicdata[u'time_formatted']
 
-                # Update display controller
-                # The primary call to this routine is in main but this call is needed to catch variable changes before musicdata_prev is updated.
-                self.display_controller.next()
+                    # Update display controller
+                    # The primary call to this routine is in main but this call is needed to catch variable changes before musicdata_prev is updated.
+                    self.display_controller.next()
+
+                # Wake the display loop so that it shows the update
+                self.display_controller.wake()
 
                 # Print the current contents of musicdata if showupdates is True
                 if self.showupdates:
@@ -308,9 +362,6 @@ class music_controller(threading.Thread):
                         except KeyError:
                             self.musicdata_prev[item] = value
 
-            # Update display data every 1/4 second
-            time.sleep(.25)
-
     def checkweatherconfiguration(self):
         if not pydPiper_config.WEATHER_SERVICE:
             logging.debug('Weather service not enabled')
@@ -577,6 +628,85 @@ class music_controller(threading.Thread):
             # Sleep until next update which occurs every minutes
             pause.sleepUntil(time.time()+300, exitapp)
 
+class display_writer(threading.Thread):
+    # Sends frames to the display on its own thread so that a slow bus does not hold up rendering or the music controller
+    # Frames are handed over through a single slot mailbox.  If a new frame arrives before the previous one has been sent
+    # the previous one is dropped as only the latest frame needs to reach the display
+
+    def __init__(self, lcd):
+        threading.Thread.__init__(self)
+        self.daemon = True
+
+        self.lcd = lcd
+        self.mailbox = None
+        self.idlepending = False
+        self.running = True
+        self.mailbox_cond = threading.Condition()
+
+        # Statistics
+        self.sent = 0 # Frames sent to the display
+        self.dropped = 0 # Frames replaced by a newer frame before they could be sent
+        self.bustime = 0.0 # Seconds spent sending the last frame
+        self.totalbustime = 0.0
+        self.maxbustime = 0.0
+
+    def post(self, img):
+        # Hand a frame to the writer, replacing any frame that has not been sent yet
+        with self.mailbox_cond:
+            if self.mailbox is not None:
+                self.dropped += 1
+            self.mailbox = img
+            self.mailbox_cond.notify()
+
+    def idle(self):
+        # Let drivers that keep track of time (e.g. for a screensaver) know the image has not changed
+        if not hasattr(self.lcd, 'idle'):
+            return
+        with self.mailbox_cond:
+            self.idlepending = True
+            self.mailbox_cond.notify()
+
+    def stop(self):
+        with self.mailbox_cond:
+            self.running = False
+            self.mailbox_cond.notify()
+
+    def stats(self):
+        return { 'sent': self.sent, 'dropped': self.dropped, 'bustime': self.bustime, 'maxbustime': self.maxbustime,
+            'avgbustime': self.totalbustime / self.sent if self.sent else 0.0 }
+
+    def run(self):
+
+        logging.debug(u"Display Writer Starting")
+
+        while True:
+            with self.mailbox_cond:
+                while self.running and self.mailbox is None and not self.idlepending:
+                    self.mailbox_cond.wait()
+                if not self.running:
+                    break
+                img = self.mailbox
+                idle = self.idlepending
+                self.mailbox = None
+                self.idlepending = False
+
+            try:
+                if img is not None:
+                    start = time.time()
+                    self.lcd.update(img)
+                    self.bustime = time.time() - start
+                    self.totalbustime += self.bustime
+                    self.maxbustime = max(self.maxbustime, self.bustime)
+                    self.sent += 1
+                elif idle:
+                    self.lcd.idle()
+            except Exception:
+                # Keep going.  The next frame will be sent in full if the driver lost track of what the display is showing
+                logging.exception(u"Error sending frame to display")
+
+        s = self.stats()
+        logging.info(u"Display Writer: {0} frames sent, {1} dropped, {2:.1f}ms average and {3:.1f}ms maximum time per frame".format(s['sent'], s['dropped'], s['avgbustime']*1000, s['maxbustime']*1000))
+
 def sigterm_handler(_signo, _stack_frame):
         sys.exit(0)
 
@@ -637,12 +767,16 @@ if __name__ == u'__main__':
     cols = pydPiper_config.DISPLAY_WIDTH
     i2c_address = pydPiper_config.DISPLAY_I2C_ADDRESS
     i2c_port = pydPiper_config.DISPLAY_I2C_PORT
+    i2c_chunk = pydPiper_config.DISPLAY_I2C_CHUNK
     enable = pydPiper_config.DISPLAY_ENABLE_DURATION
     driver = pydPiper_config.DISPLAY_DRIVER
     pagefile = pydPiper_config.PAGEFILE
     services_list.append(pydPiper_config.MUSIC_SERVICE)
     serial_port = pydPiper_config.DISPLAY_SERIAL_PORT
     serial_baudrate = pydPiper_config.DISPLAY_SERIAL_BAUDRATE
+    serial_flowcontrol = pydPiper_config.DISPLAY_SERIAL_FLOWCONTROL
+    serial_chunk = pydPiper_config.DISPLAY_SERIAL_CHUNK
+    memory_width = pydPiper_config.DISPLAY_MEMORY_WIDTH
 
     for opt, arg in opts:
         if opt == u'-h':
@@ -748,9 +882,9 @@ if __name__ == u'__main__':
     elif driver == u"hd44780":
         lcd = displays.hd44780.hd44780(rows, cols, pin_rs, pin_e, pins_data, enable)
     elif driver == u"hd44780_i2c":
-        lcd = displays.hd44780_i2c.hd44780_i2c(rows, cols, i2c_address, i2c_port, enable)
+        lcd = displays.hd44780_i2c.hd44780_i2c(rows, cols, i2c_address, i2c_port, enable, i2c_chunk)
     elif driver == u"hd44780_mcp23008":
-        lcd = displays.hd44780_i2c.hd44780_mcp23008(rows, cols, i2c_address, i2c_port, enable)
+        lcd = displays.hd44780_i2c.hd44780_mcp23008(rows, cols, i2c_address, i2c_port, enable, i2c_chunk)
     elif driver == u"ssd1306_i2c":
         lcd = displays.ssd1306_i2c.ssd1306_i2c(rows, cols, i2c_address, i2c_port)
     elif driver == u"luma_i2c":
@@ -758,7 +892,7 @@ if __name__ == u'__main__':
     elif driver == u"lcd_curses":
         lcd = displays.lcd_curses.lcd_curses(rows, cols)
     elif driver == u"gu7000":
-        lcd = displays.gu7000.gu7000(rows, cols, serial_port, serial_baudrate)
+        lcd = displays.gu7000.gu7000(rows, cols, serial_port, serial_baudrate, serial_flowcontrol, serial_chunk, memory_width)
     else:
         logging.critical(u"No valid display found")
         sys.exit()
@@ -775,14 +909,38 @@ if __name__ == u'__main__':
     mc.start()
     dc.load(pagefile, mc.musicdata,mc.musicdata_prev )
 
+    # Frames are sent to the display from their own thread so that rendering continues while the bus is busy
+    writer = display_writer(lcd)
+    writer.start()
+
     try:
+        generation = None
         while True:
-            # Get next image and send it to the display every .1 seconds
+            framestart = time.time()
+
+            # Get next image and send it to the display
             with mc.musicdata_lock:
                 img = dc.next()
+                deadline = dc.nextupdate()
 #            displays.graphics.update(img)
-            lcd.update(img)
-            time.sleep(pydPiper_config.ANIMATION_SMOOTHING)
+
+            # Only send the image if it has changed since it was last sent.
+            # Uses the generation counter as the music controller also calls next
+            if dc.generation != generation:
+                generation = dc.generation
+                writer.post(img)
+            else:
+                writer.idle()
+
+            # Sleep until the display could next change on its own (e.g. next scroll step, end of a hesitation, sequence timer)
+            # or until the music controller wakes us with new data.  Animations run at most once every ANIMATION_SMOOTHING seconds
+            nextframe = framestart + pydPiper_config.ANIMATION_SMOOTHING
+            if deadline is None or deadline > nextframe:
+                wakeat = min(deadline, framestart + MAX_IDLE) if deadline is not None else framestart + MAX_IDLE
+                dc.sleep(wakeat - time.time())
+            remaining = nextframe - time.time()
+            if remaining > 0:
+                time.sleep(remaining)
 
 
     except KeyboardInterrupt:
@@ -791,6 +949,10 @@ if __name__ == u'__main__':
     finally:
         print u"Shutting down threads"
         exitapp[0] = True
+
+        # Stop the writer before using the display from this thread
+        writer.stop()
+        writer.join()
         try:
             lcd.clear()
             lcd.message(u"Exiting...")
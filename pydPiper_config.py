@@ -31,9 +31,13 @@ DISPLAY_PINS_DATA = [ DISPLAY_PIN_D4, DISPLAY_PIN_D5, DISPLAY_PIN_D6, DISPLAY_PI
 i2c_address = safeget(config,'DISPLAY', 'display_i2c_address','0')
 DISPLAY_I2C_ADDRESS = int(i2c_address) if i2c_address and 'x' not in i2c_address else int(i2c_address,16)
 DISPLAY_I2C_PORT = int(safeget(config,'DISPLAY', 'display_i2c_port',0))
+DISPLAY_I2C_CHUNK = int(safeget(config,'DISPLAY', 'display_i2c_chunk',32)) # Values sent per I2C transaction by backpack drivers (max 33).  Set to 1 to send one byte at a time
 DISPLAY_ENABLE_DURATION = float(safeget(config,'DISPLAY', 'display_enable_duration',0)) # in microseconds.  Decrease to increase performance.  Increase to improve display stability
 DISPLAY_SERIAL_BAUDRATE = int(safeget(config,'DISPLAY','display_baudrate', 115200))
 DISPLAY_SERIAL_PORT = safeget(config,'DISPLAY', 'display_serial_port', '/dev/ttyAMA0')
+DISPLAY_SERIAL_FLOWCONTROL = safeget(config,'DISPLAY', 'display_serial_flowcontrol', 'cts') # cts (wait for CTS between chunks) or rtscts (UART hardware flow control)
+DISPLAY_SERIAL_CHUNK = int(safeget(config,'DISPLAY', 'display_serial_chunk', 4)) # Bytes sent between checks of CTS.  Keep below the display's receive buffer size
+DISPLAY_MEMORY_WIDTH = int(safeget(config,'DISPLAY', 'display_memory_width', 0)) # Columns of display memory (visible plus hidden area) for displays that can scroll in hardware.  0 disables hardware scrolling
 
 # Page Parameters
 PAGEFILE = safeget(config, 'DISPLAY', 'pagefile')
@@ -215,8 +215,10 @@ class musicdata:
 			logging.debug(u"Didn't find an appropriate header at {0}".format(url))
 
 
-	def sendUpdate(self):
+	def sendUpdate(self, elapsed=True):
 		# Figure out what has changed and then send just those values across dataqueue
+		# Input
+		#	elapsed (bool) -- Send elapsed even if it has not changed.  Pass False if elapsed was not refreshed (e.g. an update built from a notification)
 		md = { }
 		for k, v in self.musicdata.iteritems():
 			pv = self.musicdata_prev[k] if k in self.musicdata_prev else None
@@ -227,7 +229,8 @@ class musicdata:
 		# Send md to queue if anything has changed
 		if len(md) > 0:
 			# elapsed is special as it needs to be sent to guarantee that the timer gets updated correctly.  Even if it hasn't changed, send it anyway
-			md[u'elapsed'] = self.musicdata[u'elapsed']
+			if elapsed:
+				md[u'elapsed'] = self.musicdata[u'elapsed']
 			md[u'state'] = self.musicdata[u'state']
 			self.dataqueue.put(md)
 
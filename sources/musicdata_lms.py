@@ -159,8 +159,13 @@ class musicdata_lms(musicdata.musicdata):
 					#self.idle_state = True
 					msg = self.rawserver.read_until("\n", self.timeout)
 					#self.idle_state = False
-					self.status()
-					self.sendUpdate()
+					applied = self.notification(msg)
+					if applied is None:
+						# Event was for a different player
+						continue
+					if not applied:
+						self.status()
+						self.sendUpdate()
 				except (IOError, EOFError):
 					# Error occurred while trying to read from rawserver
 					# Mark rawserver None so that it is restarted on the next pass
@@ -175,10 +180,64 @@ class musicdata_lms(musicdata.musicdata):
 				continue
 
 
+	def notification(self, msg):
+		# Apply the value carried by a notification from the raw service to musicdata and send the update
+		# Returns True if the update was sent, False if a full status is needed and None if the notification was for another player
+		#
+		# Notifications look like "<player> mixer volume 50" with each field quoted
+
+		fields = [ urllib.unquote(str(f)).decode(u'utf-8') for f in msg.strip().split(u' ') ]
+		if len(fields) < 2 or fields[0] == u'subscribe':
+			# Timed out (or the reply to the subscription)
+			return False
+		if fields[0] != self.dataplayer.get_ref():
+			return None
+
+		if fields[1:3] == [ u'mixer', u'volume' ] and len(fields) == 4:
+			try:
+				volume = float(fields[3])
+			except ValueError:
+				return False
+
+			# Relative changes (e.g. +5) are reported as issued
+			if fields[3][0] in u'+-':
+				volume += self.musicdata[u'volume']
+			self.musicdata[u'volume'] = int(max(0, min(100, volume)))
+
+			# elapsed was not re-read so leave it out.  The music controller keeps counting from the last value it was sent
+			self.sendUpdate(False)
+			return True
+
+		if fields[1] == u'pause' and len(fields) == 3 and fields[2] in (u'0', u'1'):
+			self.musicdata[u'state'] = u'play' if fields[2] == u'0' else u'stop'
+
+			# The music controller restarts its timer from elapsed when playback pauses or resumes so it must be current
+			self.musicdata[u'elapsed'] = self.musicdata[u'current'] = int(self.dataplayer.get_time_elapsed())
+			self.sendUpdate()
+			return True
+
+		return False
+
+	def parsestatus(self, response):
+		# Parse the response to a tagged status query into a dictionary
+		# Each result is a quoted "key:value" pair.  Fields without a colon (e.g. what is left of the echoed command) are ignored
+		d = { }
+		for field in response.split(u' '):
+			field = urllib.unquote(str(field)).decode(u'utf-8')
+			if u':' not in field:
+				continue
+			k, v = field.split(u':', 1)
+			d[k] = v
+		return d
+
 	def status(self):
 		# Read musicplayer status and update musicdata
+		# Everything is collected with a single tagged status query
+		#	a artist, l album, d duration, u url, r bitrate, o type
 
-		state = self.dataplayer.get_mode()
+		d = self.parsestatus(self.dataplayer.request(u"status - 1 tags:aldruo", True))
+
+		state = d.get(u'mode', u'stop')
 
 		if state != u"play":
 			self.musicdata[u'state'] = u"stop"
@@ -187,23 +246,20 @@ class musicdata_lms(musicdata.musicdata):
 			self.musicdata[u'state'] = u"play"
 
 		# Update values
-		self.musicdata[u'artist'] = urllib.unquote(str(self.dataplayer.request("artist ?", True))).decode('utf-8')
-		self.musicdata[u'title'] = urllib.unquote(str(self.dataplayer.request("title ?", True))).decode('utf-8')
-		self.musicdata[u'album'] = urllib.unquote(str(self.dataplayer.request("album ?", True))).decode('utf-8')
+		self.musicdata[u'artist'] = d.get(u'artist', u'')
+		self.musicdata[u'title'] = d.get(u'title', u'')
+		self.musicdata[u'album'] = d.get(u'album', u'')
 
-		self.musicdata[u'volume'] = self.dataplayer.get_volume()
+		self.musicdata[u'volume'] = int(self.floatn(d.get(u'mixer volume')))
 
-		self.musicdata[u'elapsed'] = int(self.dataplayer.get_time_elapsed())
-		try:
-			self.musicdata[u'length'] = int(self.dataplayer.get_track_duration())
-		except:
-			self.musicdata[u'length'] = 0
+		self.musicdata[u'elapsed'] = int(self.floatn(d.get(u'time')))
+		self.musicdata[u'length'] = int(self.floatn(d.get(u'duration')))
 
 		# For backwards compatibility
 		self.musicdata[u'current'] = self.musicdata[u'elapsed']
 		self.musicdata[u'duration'] = self.musicdata[u'length']
 
-		playlist_mode = int(self.dataplayer.request("playlist repeat ?", True))
+		playlist_mode = self.intn(d.get(u'playlist repeat', 0))
 		if playlist_mode == 0:
 			self.musicdata[u'single'] = self.musicdata[u'repeat'] = False
 		elif playlist_mode == 1:
@@ -216,7 +272,7 @@ class musicdata_lms(musicdata.musicdata):
 			logging.debug(u"Unexpected value received when querying playlist mode status (e.g. single, repeat)")
 			self.musicdata[u'single'] = self.musicdata[u'repeat'] = False
 
-		shuffle_mode = int(self.dataplayer.request("playlist shuffle ?", True))
+		shuffle_mode = self.intn(d.get(u'playlist shuffle', 0))
 		if shuffle_mode == 0:
 			self.musicdata[u'random'] = False
 		elif shuffle_mode == 1 or shuffle_mode == 2:
@@ -226,8 +282,8 @@ class musicdata_lms(musicdata.musicdata):
 			self.musicdata[u'random'] =  False
 
 
-		plp = self.musicdata[u'playlist_position'] = int(self.dataplayer.request("playlist index ?"))+1
-		plc = self.musicdata[u'playlist_length'] = self.dataplayer.playlist_track_count()
+		plp = self.musicdata[u'playlist_position'] = self.intn(d.get(u'playlist_cur_index', -1))+1
+		plc = self.musicdata[u'playlist_length'] = self.intn(d.get(u'playlist_tracks', 0))
 		# For backwards compatibility
 		self.musicdata[u'playlist_count'] = self.musicdata[u'playlist_length']
 
@@ -260,7 +316,7 @@ class musicdata_lms(musicdata.musicdata):
 
 		self.musicdata[u'musicdatasource'] = u"LMS"
 
-		url = self.dataplayer.get_track_path().decode()
+		url = d.get(u'url', u'')
 		self.musicdata[u'uri'] = url
 
 		urlp = urlparse.urlparse(url)
@@ -276,16 +332,9 @@ class musicdata_lms(musicdata.musicdata):
 			self.musicdata[u'actPlayer'] = urlp.scheme
 
 
-		# Get bitrate and tracktype if they are available.  Try blocks used to prevent array out of bounds exception if values are not found
-		try:
-			self.musicdata[u'bitrate'] = urllib.unquote(str(self.dataplayer.request("songinfo 2 1 url:"+url+" tags:r", True))).decode(u'utf-8').split(u"bitrate:", 1)[1]
-		except:
-			self.musicdata[u'bitrate'] = u""
-
-		try:
-			self.musicdata[u'encoding'] = urllib.unquote(str(self.dataplayer.request("songinfo 2 1 url:"+url+" tags:o", True))).decode(u'utf-8').split(u"type:",1)[1]
-		except:
-			self.musicdata[u'encoding'] = u""
+		# Bitrate and tracktype are only present if the server knows them
+		self.musicdata[u'bitrate'] = d.get(u'bitrate', u'')
+		self.musicdata[u'encoding'] = d.get(u'type', u'')
 
 		self.musicdata[u'tracktype'] = self.musicdata[u'encoding']
 
@@ -5,12 +5,13 @@
 # Written by: Ron Ritchey
 from __future__ import unicode_literals
 
-import json, mpd, threading, logging, Queue, time, sys, getopt
+import json, mpd, threading, logging, Queue, time, sys, getopt, select
 import musicdata
 
 class musicdata_mpd(musicdata.musicdata):
 
-
+	# MPD subsystems that affect what is displayed
+	SUBSYSTEMS = [ u'player', u'mixer', u'options', u'playlist' ]
 
 	def __init__(self, q, server=u'localhost', port=6600, pwd=u''):
 		super(musicdata_mpd, self).__init__(q)
@@ -19,9 +20,9 @@ class musicdata_mpd(musicdata.musicdata):
 		self.pwd = pwd
 		self.connection_failed = 0
 		self.timeout = 20
-		self.idle_state = False
 
 		self.dataclient = None
+		self.current_song = None
 
 		# Now set up a thread to listen to the channel and update our data when
 		# the channel indicates a relevant key has changed
@@ -29,25 +30,6 @@ class musicdata_mpd(musicdata.musicdata):
 		data_t.daemon = True
 		data_t.start()
 
-		# Start the idle timer
-		idle_t = threading.Thread(target=self.idlealert)
-		idle_t.daemon = True
-		idle_t.start()
-
-	def idlealert(self):
-
-		while True:
-			# Generate a noidle event every timeout seconds
-			time.sleep(self.timeout)
-
-			if self.idle_state:
-				try:
-					#self.dataclient.noidle()
-					self.dataclient._write_command("noidle")
-				except (mpd.CommandError, NameError, mpd.ConnectionError, AttributeError):
-					# If not idle (or not created yet) return to sleeping
-					pass
-
 	def connect(self):
 
 		# Try up to 10 times to connect to MPD
@@ -66,6 +48,7 @@ class musicdata_mpd(musicdata.musicdata):
 				client.connect(self.server, self.port)
 
 				self.dataclient = client
+				self.current_song = None
 				break
 			except:
 				self.dataclient = None
@@ -97,10 +80,8 @@ class musicdata_mpd(musicdata.musicdata):
 
 			try:
 				# Wait for notice that state has changed
-				self.idle_state = True
-				msg = self.dataclient.idle()
-				self.idle_state = False
-				self.status()
+				changed = self.idle()
+				self.status(changed)
 				self.sendUpdate()
 				time.sleep(.01)
 			except mpd.ConnectionError:
@@ -110,13 +91,38 @@ class musicdata_mpd(musicdata.musicdata):
 				continue
 
 
-	def status(self):
+	def idle(self):
+		# Wait for one of the displayed subsystems to change
+		# Returns the subsystems that changed (empty if timeout seconds passed without a change)
+
+		self.dataclient.send_idle(*self.SUBSYSTEMS)
+		try:
+			r, w, x = select.select([ self.dataclient ], [], [], self.timeout)
+		except select.error:
+			# Interrupted.  Treat it like a timeout
+			r = [ ]
+
+		if r:
+			return self.dataclient.fetch_idle()
+
+		# Nothing changed.  Leave idle so that the status (e.g. elapsed time) gets refreshed
+		return self.dataclient.noidle()
+
+	def status(self, changed=None):
 		# Read musicplayer status and update musicdata
+		# changed holds the subsystems that changed (None to refresh everything).  The current song only needs
+		# to be read again if the player or playlist changed
 
 		try:
-			status = self.dataclient.status()
-			current_song = self.dataclient.currentsong()
-			playlist_info = self.dataclient.playlistinfo()
+			if changed is None or self.current_song is None or u'player' in changed or u'playlist' in changed:
+				# Get status and current song in a single round trip
+				self.dataclient.command_list_ok_begin()
+				self.dataclient.status()
+				self.dataclient.currentsong()
+				status, self.current_song = self.dataclient.command_list_end()
+			else:
+				status = self.dataclient.status()
+			current_song = self.current_song
 		except:
 			# Caught something else.  Report it and then inform calling function that the connection is bad
 			e = sys.exc_info()[0]